@@ -0,0 +1,370 @@
+# Asyncio interface for multiple DW1000 UWB modules
+# Copyright (c) Jeremy P Bentham 2019. See iosoft.blog for details
+#
+# A single event loop drives many units concurrently; register transfers
+# are queued by the Reg class, then sent using 'await spi.aflush()'.
+# Infrequent operations such as initialisation re-use the blocking DW1000
+# code, running in an executor thread.
+
+import sys, asyncio, threading
+from dw1000_regs import Reg, DW1000, TX_BUFFER, RX_BUFFER, LONG_FRAMES
+from dw1000_spi import Spi, RESET_VAL, SEQLEN, RETRIES, WINDOW
+from dw1000_spi import queue_chunks, split_blocks, read_resp, is_irq, irq_readout_data
+from dw1000_spi import frame, unframe, parse_spif, request_data
+
+# Asyncio SPI interface, using futures keyed by sequence number
+# Acts as a datagram (UDP) or stream (TCP or Unix socket) protocol
+class AsyncSpi(Spi, asyncio.DatagramProtocol, asyncio.Protocol):
+    def __init__(self, spif, ident='1'):
+        self.irq_event = asyncio.Event()
+        self.loop = asyncio.get_running_loop()
+        self.thread = threading.get_ident()
+        self.transport = None
+        Spi.__init__(self, spif, ident)
+        self.txseq = 1
+        self.slots = asyncio.Semaphore(WINDOW)
+
+    # Connection is made by open(), not when the interface is created
+    def connect(self):
+        pass
+
+    # Open a connection to the SPI server
+    @classmethod
+    async def open(cls, spif, ident='1'):
+        loop = asyncio.get_running_loop()
+        if spif[0] == "UNIX":
+            transport, spi = await loop.create_unix_connection(
+                lambda: cls(spif, ident), spif[1])
+        elif spif[0] == "TCP":
+            transport, spi = await loop.create_connection(
+                lambda: cls(spif, ident), *spif[1:])
+        else:
+            transport, spi = await loop.create_datagram_endpoint(
+                lambda: cls(spif, ident), remote_addr=spif[1:])
+        return spi
+
+    # Save transport when connection is made
+    def connection_made(self, transport):
+        self.transport = transport
+
+    # Handle incoming stream data, split into length-prefixed messages
+    def data_received(self, data):
+        self.buff += data
+        msg, self.buff = unframe(self.buff)
+        while msg is not None:
+            self.datagram_received(msg, None)
+            msg, self.buff = unframe(self.buff)
+
+    # Send request datagram or stream message
+    def send_msg(self, txdata):
+        if self.stream:
+            self.transport.write(frame(txdata))
+        else:
+            self.transport.sendto(txdata)
+
+    # Handle incoming datagram: IRQ message, or response to a request
+    def datagram_received(self, data, addr):
+        resp = bytearray(data)
+        if is_irq(resp):
+            self.stats.irqs += 1
+            self.irq_data = irq_readout_data(resp)
+            self.irq_event.set()
+        elif len(resp) > SEQLEN:
+            fut = self.pending.get(resp[0])
+            if fut and not fut.done():
+                fut.set_result(resp)
+            else:
+                self.stats.stale += 1
+
+    # Return True if called from the event loop thread
+    def in_loop(self):
+        return threading.get_ident() == self.thread
+
+    # Interrupt flag, for compatibility with the blocking interface
+    @property
+    def interrupt(self):
+        return self.irq_event.is_set()
+
+    @interrupt.setter
+    def interrupt(self, on):
+        func = self.irq_event.set if on else self.irq_event.clear
+        if self.in_loop():
+            func()
+        else:
+            self.loop.call_soon_threadsafe(func)
+
+    # Queue an SPI transfer; in the event loop thread, transfers are
+    # always queued, and sent by aflush()
+    def xfer(self, txdata, callback=None):
+        if self.queue is None and self.in_loop():
+            self.queue = []
+        return Spi.xfer(self, txdata, callback)
+
+    # Send queued transfers, pass responses to callbacks
+    async def aflush(self):
+        queue, self.queue, self.depth = self.queue or [], None, 0
+        for chunk in queue_chunks(queue):
+            resps = await self.atransact([txdata for txdata, callback in chunk])
+            for (txdata, callback), resp in zip(chunk, resps):
+                if callback:
+                    callback(read_resp(resp))
+
+    # Send one or more SPI blocks in a single datagram, return responses
+    # Up to WINDOW requests from concurrent tasks may be outstanding
+    async def atransact(self, blocks, nresps=None):
+        async with self.slots:
+            return await self.atransact_req(blocks, nresps)
+
+    # Send request datagram, wait for response
+    async def atransact_req(self, blocks, nresps=None):
+        txdata = request_data(self.txseq, blocks)
+        self.txseq = (self.txseq % 255) + 1
+        fut = self.loop.create_future()
+        self.pending[txdata[0]] = fut
+        rxdata = []
+        start = self.loop.time()
+        try:
+            for n in range(RETRIES+1):
+                if n:
+                    self.backoff()
+                if n == 0 or not self.stream:
+                    self.send_msg(txdata)
+                    if n:
+                        self.stats.retries += 1
+                try:
+                    rxdata = await asyncio.wait_for(asyncio.shield(fut), self.rto)
+                    break
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self.pending.pop(txdata[0], None)
+        if rxdata:
+            rtt = self.loop.time() - start
+            self.stats.add_rtt(rtt)
+            if n == 0:
+                self.update_rtt(rtt)
+        else:
+            self.stats.timeouts += 1
+        return split_blocks(rxdata, len(blocks) if nresps is None else nresps)
+
+    # Blocking transfer, for use from an executor thread
+    def transact(self, blocks, nresps=None):
+        return self.call(self.atransact(blocks, nresps))
+
+    # Send request without waiting, from an executor thread
+    # Returns a handle for wait(); the RTT is measured when the reply
+    # arrives, so posted requests are treated the same
+    def submit(self, blocks, nresps=None, callbacks=None, posted=False):
+        return self.start(self.atransact(blocks, nresps)), callbacks
+
+    # Wait for request, from an executor thread; return responses, and
+    # pass them to the callbacks (if any)
+    def wait(self, req):
+        fut, callbacks = req
+        resps = fut.result()
+        for callback, resp in zip(callbacks or [], resps):
+            if callback:
+                callback(read_resp(resp))
+        return resps
+
+    # Wait for IRQ, return False if timeout
+    async def wait_irq(self, timeout=None):
+        timeout = self.irq_timeout if timeout is None else timeout
+        try:
+            await asyncio.wait_for(self.irq_event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self.irq_event.is_set()
+
+    # Blocking wait for IRQ, for use from an executor thread
+    def receive(self, irq_return=False):
+        if irq_return:
+            self.call(self.wait_irq())
+        return []
+
+    # Run coroutine in the event loop, from an executor thread
+    def call(self, coro):
+        return self.start(coro).result()
+
+    # Start coroutine in the event loop from an executor thread, return future
+    def start(self, coro):
+        if self.in_loop():
+            coro.close()
+            raise RuntimeError("Blocking SPI call in event loop")
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    # Assert or negate hardware reset pin
+    async def areset(self, on):
+        await self.atransact([[RESET_VAL] if on else [0]])
+
+    # Close transport
+    def close(self):
+        if self.transport:
+            self.transport.close()
+        self.transport = None
+
+# Asyncio facade for DW1000 chip
+class AsyncDW1000(object):
+    def __init__(self, spi):
+        self.spi = spi
+        self.dw = DW1000(spi)
+
+    # Run blocking DW1000 method in an executor thread
+    async def run(self, func, *args):
+        return await self.spi.loop.run_in_executor(None, func, *args)
+
+    # Hardware reset
+    async def reset(self):
+        await self.spi.areset(True)
+        await asyncio.sleep(0.001)
+        await self.spi.areset(False)
+        await asyncio.sleep(0.01)
+        self.dw.invalidate()
+        return await self.read('DEV_ID')
+
+    # Test IRQ pin operation
+    async def test_irq(self):
+        self.dw.clear_interrupt()
+        await self.run(self.dw.pulse_irq)
+        ret = await self.spi.wait_irq()
+        self.dw.clear_interrupt()
+        return ret
+
+    # Initialise DW1000 (slow, so run in executor)
+    async def initialise(self, *args):
+        await self.run(self.dw.initialise, *args)
+
+    # Change configuration parameters, writing only the registers that differ
+    async def configure(self, *args):
+        return await self.run(self.dw.configure, *args)
+
+    # Read accumulator samples (large transfer, so run in executor)
+    async def read_accum(self, start=0, count=None):
+        return await self.run(self.dw.read_accum, start, count)
+
+    # Read register
+    async def read(self, name):
+        r = Reg(name).read(self.spi)
+        await self.spi.aflush()
+        return r
+
+    # Return register with value from shadow cache; read if not cached
+    async def shadow_reg(self, name):
+        r = Reg(name)
+        val = self.spi.shadow.get(r.rdef.key)
+        return await self.read(name) if val is None else r.load(val)
+
+    # Load Tx buffer and start transmission
+    async def transmit(self, data, rx=False):
+        fctrl = await self.shadow_reg('TX_FCTRL')
+        self.spi.xfer([TX_BUFFER[0] + 0x80] + list(data))
+        fctrl.set('TFLEN', len(data)+2).write(self.spi)
+        Reg('SYS_CTRL').set('TXSTRT', 1).set('WAIT4RESP', rx).write(self.spi)
+        await self.spi.aflush()
+
+    # Load Tx buffer and start delayed transmission at device time 'dx',
+    # in a single transfer. If the time had passed (HPDWARN), cancel the
+    # transmission and return False
+    async def transmit_at(self, dx, data):
+        fctrl = await self.shadow_reg('TX_FCTRL')
+        self.spi.xfer([TX_BUFFER[0] + 0x80] + list(data))
+        fctrl.set('TFLEN', len(data)+2).write(self.spi)
+        Reg('DX_TIME', dx).write(self.spi)
+        Reg('SYS_CTRL').set('TXDLYS', 1).set('TXSTRT', 1).write(self.spi)
+        status = Reg('SYS_STATUS').read(self.spi)
+        await self.spi.aflush()
+        if status.reg.HPDWARN:
+            self.dw.cancel_tx()
+            await self.spi.aflush()
+            return False
+        return True
+
+    # Read device clock, return (host time, SYS_TIME value, round-trip time)
+    # The host time is the midpoint of the transfer
+    async def sys_time(self):
+        start = self.spi.loop.time()
+        r = await self.read('SYS_TIME')
+        end = self.spi.loop.time()
+        return (start + end) / 2.0, r.value, end - start
+
+    # Enable receiver
+    async def start_rx(self):
+        self.dw.clear_interrupt()
+        Reg('SYS_CTRL').set('RXENAB', 1).write(self.spi)
+        await self.spi.aflush()
+
+    # Check for interrupt; if no IRQ, check status reg
+    async def check_interrupt(self, timeout=None):
+        interrupt = await self.spi.wait_irq(timeout)
+        if not interrupt:
+            self.spi.stats.missed_irqs += 1
+            interrupt = (await self.read('SYS_STATUS')).reg.IRQS
+        return interrupt
+
+    # Get Rx data, using register values pushed with IRQ if available
+    async def get_rxdata(self, timeout=None):
+        rxdata = []
+        if await self.check_interrupt(timeout):
+            self.dw.snapshot = snap = self.dw.irq_snapshot()
+            if snap:
+                status, finfo, rxbuff = snap['SYS_STATUS'], snap['RX_FINFO'], snap['RX_BUFFER']
+            else:
+                status, finfo = Reg('SYS_STATUS').read(self.spi), Reg('RX_FINFO').read(self.spi)
+                await self.spi.aflush()
+                rxbuff = None
+            if status.reg.RXDFR:
+                rxdata = await self.rx_data(finfo, rxbuff)
+        return rxdata
+
+    # Get data from Rx buffer, excluding CRC
+    async def rx_data(self, finfo, rxbuff=None):
+        nbytes = finfo.reg.RXFLEN
+        if not LONG_FRAMES:
+            nbytes &= 0x7f
+        if rxbuff is not None and 2 < nbytes <= len(rxbuff):
+            return memoryview(rxbuff)[:nbytes-2]
+        if nbytes > 2:
+            resp = bytearray()
+            self.spi.xfer([RX_BUFFER[0]] + nbytes*[0], resp.extend)
+            await self.spi.aflush()
+            return memoryview(resp)[1:-2] if resp else []
+        return []
+
+    # Clear events in interrupt register
+    async def clear_irq(self):
+        status = self.dw.snapshot['SYS_STATUS'] if self.dw.snapshot else None
+        if status is None:
+            status = await self.read('SYS_STATUS')
+        status.write(self.spi)
+        await self.spi.aflush()
+
+    # Get Tx and Rx timestamps in a single transfer
+    async def txrx_times(self):
+        tx = Reg('TX_TIME1').read(self.spi)
+        rx = self.dw.snapshot['RX_TIME1'] if self.dw.snapshot else Reg('RX_TIME1').read(self.spi)
+        await self.spi.aflush()
+        return tx.reg.TX_STAMP, rx.reg.RX_STAMP
+
+# Reset, test and initialise all units concurrently
+async def start_units(spifs):
+    spis = await asyncio.gather(*[AsyncSpi.open(spif, str(n+1))
+                                  for n, spif in enumerate(spifs)])
+    dws = [AsyncDW1000(spi) for spi in spis]
+    ids = await asyncio.gather(*[dw.reset() for dw in dws])
+    for spi, r in zip(spis, ids):
+        print("Unit %s: %s" % (spi.ident, r.field_vals()))
+    irqs = await asyncio.gather(*[dw.test_irq() for dw in dws])
+    for spi, irq in zip(spis, irqs):
+        if not irq:
+            print("No interrupt from unit %s" % spi.ident)
+    await asyncio.gather(*[dw.initialise() for dw in dws])
+    return dws
+
+if __name__ == "__main__":
+    spifs = [parse_spif(arg) for arg in sys.argv[1:]]
+    if not spifs:
+        print("Usage: dw1000_async.py [tcp:|unix:]<IP_ADDR>[:<PORT_NUM>] ...")
+        sys.exit(1)
+    asyncio.run(start_units(spifs))
+
+# EOF
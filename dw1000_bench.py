@@ -0,0 +1,175 @@
+# Benchmarks for DW1000 register codec, SPI transfers and ranging rate
+# Copyright (c) Jeremy P Bentham 2019. See iosoft.blog for details
+#
+# Results are printed, and optionally saved as JSON. If a previous results
+# file is given, the program fails if any result is worse by more than
+# the tolerance, e.g.
+#   python dw1000_bench.py -o base.json
+#   python dw1000_bench.py -c base.json -t 0.2
+
+import sys, time, json, timeit
+from dw1000_regs import Reg, DW1000
+from dw1000_spi import Spi, ANS_VAL
+from dw1000_range import Frame, BLINK_MSG, exchange, delayed_exchange, range_frame
+from dw1000_twr import twr_dists, twr_arrays, valid_dist
+from dw1000_sim import Simulator
+
+VERSION     = "0.01"
+SIM_PORT    = 16401     # First port number for simulated units
+MICRO_TIME  = 0.2       # Approximate time for each micro-benchmark (sec)
+XFER_COUNT  = 500       # Number of transfers for round-trip tests
+XFER_LATENCY= 0.001     # Simulated network latency for pipelining test (sec)
+TWR_COUNT   = 50        # Number of DS-TWR exchanges
+TWR_BATCH   = 1000      # Number of exchanges in batch calculation
+
+# Dummy SPI interface, returning fixed data for reads
+class NullSpi(object):
+    def __init__(self):
+        self.shadow = {}
+        self.resp = bytearray([ANS_VAL] + 8*[0x55])
+    def xfer(self, txdata, callback=None):
+        if callback:
+            callback(self.resp)
+        return self.resp
+
+# Benchmark results, each with a value, unit, and direction
+class Results(object):
+    def __init__(self):
+        self.results = {}
+
+    # Add a result, and print it
+    def add(self, name, value, unit, higher_better):
+        self.results[name] = {"value":value, "unit":unit, "higher_better":higher_better}
+        print("%-24s %12.3f %s" % (name, value, unit))
+
+    # Return list of regressions compared with a previous set of results
+    def regressions(self, base, tolerance):
+        fails = []
+        for name, old in base.items():
+            new = self.results.get(name)
+            if new and old["value"]:
+                ratio = new["value"] / old["value"]
+                if not new["higher_better"]:
+                    ratio = 1.0 / ratio if ratio else float('inf')
+                if ratio < 1.0 - tolerance:
+                    fails.append("%s: %1.3f -> %1.3f %s" % (name, old["value"],
+                                 new["value"], new["unit"]))
+        return fails
+
+    # Return JSON string
+    def json(self):
+        return json.dumps({"version":VERSION, "time":time.time(),
+                           "results":self.results}, indent=2, sort_keys=True)
+
+# Return time per call of a function, in microseconds
+def usec_per_call(func):
+    timer = timeit.Timer(func)
+    n, t = timer.autorange()
+    n = max(int(n * MICRO_TIME / max(t, 1e-9)), 1)
+    return min(timer.repeat(3, n)) / n * 1e6
+
+# Register codec and frame micro-benchmarks
+def bench_micro(res):
+    spi = NullSpi()
+    frame = Frame(BLINK_MSG)
+    r = Reg('TX_FCTRL')
+    res.add("reg_create", usec_per_call(lambda: Reg('SYS_STATUS')), "us", False)
+    res.add("reg_set", usec_per_call(lambda: r.set('TFLEN', 12)), "us", False)
+    res.add("reg_get", usec_per_call(lambda: r.reg.TFLEN), "us", False)
+    res.add("reg_read", usec_per_call(lambda: Reg('RX_TIME1').read(spi)), "us", False)
+    res.add("reg_write", usec_per_call(lambda: Reg('TX_FCTRL', 0x1234).write(spi)), "us", False)
+    res.add("frame_data", usec_per_call(frame.data), "us", False)
+    ts = (1000, 2000, 3000, 4000, 5000, 6000)
+    res.add("twr_dists", usec_per_call(lambda: twr_dists(*ts)), "us", False)
+    batch = [[t]*TWR_BATCH for t in ts]
+    res.add("twr_batch", usec_per_call(lambda: twr_arrays(*batch))/TWR_BATCH, "us", False)
+
+# SPI round-trip latency and throughput against simulated unit, with
+# stop-and-wait transfers, then up to WINDOW posted transfers outstanding
+# On loopback, the simulator shares the CPU (and GIL) with the client, so
+# the pipelining gain is only seen with simulated network latency
+def bench_xfer(res, name, loss=0.0, latency=0.0):
+    sim = Simulator(1, SIM_PORT, latency=latency, loss=loss).start()
+    spi = Spi(sim.spifs()[0])
+    times = []
+    start = time.perf_counter()
+    for n in range(XFER_COUNT):
+        t = time.perf_counter()
+        Reg('SYS_STATUS').read(spi)
+        times.append(time.perf_counter() - t)
+    total = time.perf_counter() - start
+    reqs, regs = [], []
+    start = time.perf_counter()
+    for n in range(XFER_COUNT):
+        spi.begin()
+        regs.append(Reg('SYS_STATUS').read(spi))
+        reqs += spi.post()
+    spi.wait_all(reqs)
+    window_total = time.perf_counter() - start
+    spi.close()
+    sim.stop()
+    times.sort()
+    res.add(name+"_rtt_median", times[len(times)//2]*1e6, "us", False)
+    res.add(name+"_rtt_p99", times[int(len(times)*0.99)]*1e6, "us", False)
+    res.add(name+"_rate", XFER_COUNT/total, "xfer/s", True)
+    res.add(name+"_window_rate", XFER_COUNT/window_total, "xfer/s", True)
+
+# End-to-end DS-TWR exchange rate between two simulated units, using the
+# immediate or delayed-reply exchange from the ranging program
+def bench_twr(res, name, delayed=False):
+    sim = Simulator(2, SIM_PORT+10, distance=3.0).start()
+    dws = [DW1000(Spi(spif, str(n+1))) for n, spif in enumerate(sim.spifs())]
+    for dw in dws:
+        dw.reset()
+        dw.initialise()
+    dw1, dw2 = dws
+    frame1, frame2 = range_frame(1), range_frame(2)
+    count = 0
+    start = time.perf_counter()
+    for n in range(TWR_COUNT):
+        if delayed:
+            tstamps = delayed_exchange(dw1, dw2, frame1, frame2)
+        else:
+            tstamps = exchange(dw1, dw2, frame1, frame2)
+        if tstamps and valid_dist(twr_dists(*tstamps)[1]):
+            count += 1
+    total = time.perf_counter() - start
+    for dw in dws:
+        dw.spi.close()
+    sim.stop()
+    res.add(name, count/total, "ranges/s", True)
+
+if __name__ == "__main__":
+    outfile = basefile = None
+    tolerance = 0.2
+    args = iter(sys.argv[1:])
+    for arg in args:
+        if arg == "-o":
+            outfile = next(args)
+        elif arg == "-c":
+            basefile = next(args)
+        elif arg == "-t":
+            tolerance = float(next(args))
+        else:
+            print("Unrecognised argument '%s'" % arg)
+            print("Usage: dw1000_bench.py [-o results.json] [-c baseline.json] [-t tolerance]")
+            sys.exit(1)
+    print("DW1000_BENCH v" + VERSION)
+    res = Results()
+    bench_micro(res)
+    bench_xfer(res, "xfer")
+    bench_xfer(res, "xfer_loss", 0.05)
+    bench_xfer(res, "xfer_latency", latency=XFER_LATENCY)
+    bench_twr(res, "twr_rate")
+    bench_twr(res, "twr_delayed_rate", True)
+    if outfile:
+        with open(outfile, "w") as f:
+            f.write(res.json())
+    if basefile:
+        with open(basefile) as f:
+            fails = res.regressions(json.load(f)["results"], tolerance)
+        for fail in fails:
+            print("Regression: " + fail)
+        sys.exit(1 if fails else 0)
+
+# EOF
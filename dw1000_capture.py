@@ -0,0 +1,110 @@
+# Binary capture of DW1000 ranging timestamps, for offline analysis
+# Copyright (c) Jeremy P Bentham 2019. See iosoft.blog for details
+#
+# The file has a fixed-size header, then fixed-size records: host time,
+# exchange number, initiator & responder unit numbers, and the 6 DS-TWR
+# timestamps. Space is preallocated, and doubled when full. The record
+# count in the header is updated after every record, so the file is
+# usable if the program is stopped.
+# The reader maps the file as a NumPy structured array, so large captures
+# aren't loaded into memory.
+
+import sys, os, time, struct
+from dw1000_twr import twr_arrays
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+CAPTURE_MAGIC   = b'DWTS'
+CAPTURE_VERSION = 1
+CAPTURE_PREALLOC= 65536     # Initial number of records preallocated
+CHUNK_RECS      = 1 << 20   # Number of records processed at a time
+HDR_FMT         = struct.Struct('<4sHHQQ')  # Magic, version, rec size, capacity, count
+HDR_SIZE        = 64
+COUNT_OSET      = 16        # Offset of record count in header
+REC_FMT         = struct.Struct('<dIBB2x6Q')
+TSTAMP_NAMES    = ('tx1', 'rx1', 'tx2', 'rx2', 'tx3', 'rx3')
+
+if np is not None:
+    REC_DTYPE = np.dtype([('time', '<f8'), ('seq', '<u4'), ('init', 'u1'),
+                          ('resp', 'u1'), ('pad', 'V2')] +
+                         [(name, '<u8') for name in TSTAMP_NAMES])
+
+# Writer for capture file; an existing file is appended
+class CaptureWriter(object):
+    def __init__(self, fname, prealloc=CAPTURE_PREALLOC):
+        exists = os.path.exists(fname) and os.path.getsize(fname) >= HDR_SIZE
+        self.fd = os.open(fname, os.O_RDWR | os.O_CREAT, 0o644)
+        if exists:
+            self.capacity, self.count = read_header(os.pread(self.fd, HDR_SIZE, 0))
+        else:
+            self.count = 0
+            self.allocate(prealloc)
+
+    # Preallocate space for a number of records, and update header
+    def allocate(self, capacity):
+        self.capacity = capacity
+        os.ftruncate(self.fd, HDR_SIZE + capacity*REC_FMT.size)
+        hdr = HDR_FMT.pack(CAPTURE_MAGIC, CAPTURE_VERSION, REC_FMT.size,
+                           capacity, self.count)
+        os.pwrite(self.fd, hdr + bytes(HDR_SIZE - len(hdr)), 0)
+
+    # Add record with exchange number, unit numbers & 6 timestamps
+    def add(self, seq, init, resp, tstamps, t=None):
+        if self.count >= self.capacity:
+            self.allocate(self.capacity * 2)
+        rec = REC_FMT.pack(time.time() if t is None else t, seq, init, resp, *tstamps)
+        os.pwrite(self.fd, rec, HDR_SIZE + self.count*REC_FMT.size)
+        self.count += 1
+        os.pwrite(self.fd, struct.pack('<Q', self.count), COUNT_OSET)
+
+    # Close file
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+        self.fd = None
+
+# Return capacity & record count from file header
+def read_header(hdr):
+    magic, version, recsize, capacity, count = HDR_FMT.unpack(hdr[:HDR_FMT.size])
+    if magic != CAPTURE_MAGIC or recsize != REC_FMT.size:
+        raise ValueError("Not a timestamp capture file")
+    return capacity, count
+
+# Return records in capture file as a read-only memory-mapped array
+# Without NumPy, return a list of tuples
+def open_capture(fname):
+    with open(fname, "rb") as f:
+        capacity, count = read_header(f.read(HDR_SIZE))
+        if np is None:
+            return [REC_FMT.unpack(f.read(REC_FMT.size)) for n in range(count)]
+    if count == 0:
+        return np.zeros(0, dtype=REC_DTYPE)
+    return np.memmap(fname, dtype=REC_DTYPE, mode='r', offset=HDR_SIZE, shape=(count,))
+
+# Return iterator for SS & DS distance arrays, calculated in chunks
+def capture_dists(recs, chunk=CHUNK_RECS):
+    for n in range(0, len(recs), chunk):
+        part = recs[n:n+chunk]
+        if np is None:
+            yield twr_arrays(*[[r[4+i] for r in part] for i in range(6)])
+        else:
+            yield twr_arrays(*[part[name] for name in TSTAMP_NAMES])
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: dw1000_capture.py <capture_file>")
+        sys.exit(1)
+    recs = open_capture(sys.argv[1])
+    print("%u records" % len(recs))
+    for ss, ds in capture_dists(recs):
+        if np is None:
+            for d1, d2 in zip(ss, ds):
+                print("%7.3f %7.3f" % (d1, d2))
+        else:
+            print("DS mean %7.3f std %7.3f, SS mean %7.3f (%u ranges)" % (
+                  np.nanmean(ds), np.nanstd(ds), np.nanmean(ss),
+                  np.count_nonzero(~np.isnan(ds))))
+
+# EOF
@@ -0,0 +1,157 @@
+# Streaming filters for DW1000 range values
+# Copyright (c) Jeremy P Bentham 2019. See iosoft.blog for details
+#
+# Each filter has an add() method that takes a range value & time, and
+# returns the filtered value, or None if the value is rejected. Filters
+# are combined in a Pipeline; a FilterBank keeps a pipeline for each
+# pair of units. State is held in fixed-size buffers, so there is no
+# memory allocation per value.
+
+import sys, time, math, bisect
+from array import array
+
+MEDIAN_LEN  = 5         # Number of values in sliding median
+GATE_LEN    = 9         # Number of values in outlier gate window
+GATE_LIMIT  = 0.5       # Max distance from window median (metres)
+GATE_RESET  = 5         # Consecutive rejects before gate restarts
+KF_MEAS_VAR = 0.01      # Kalman measurement variance (metres^2)
+KF_ACCEL_VAR= 1.0       # Kalman acceleration variance ((m/s^2)^2)
+KF_RESET    = 2.0       # Kalman restart if gap is longer than this (sec)
+
+# Fixed-length window of recent values, with sorted copy for median
+class Window(object):
+    def __init__(self, size):
+        self.size = size
+        self.values = array('d', bytes(8*size))
+        self.sorted = []
+        self.count = 0
+
+    # Add value, removing oldest if window is full
+    def add(self, val):
+        n = self.count % self.size
+        if self.count >= self.size:
+            del self.sorted[bisect.bisect_left(self.sorted, self.values[n])]
+        self.values[n] = val
+        bisect.insort(self.sorted, val)
+        self.count += 1
+
+    # Return median of values in window
+    def median(self):
+        n = len(self.sorted)
+        return (self.sorted[(n-1)//2] + self.sorted[n//2]) / 2.0 if n else None
+
+    # Remove all values
+    def clear(self):
+        del self.sorted[:]
+        self.count = 0
+
+# Sliding median filter
+class Median(object):
+    def __init__(self, size=MEDIAN_LEN):
+        self.window = Window(size)
+
+    def add(self, val, t=None):
+        self.window.add(val)
+        return self.window.median()
+
+# Reject values that are too far from the median of recent accepted values
+# If there are too many consecutive rejects (e.g. the unit has moved),
+# the window is restarted
+class Gate(object):
+    def __init__(self, limit=GATE_LIMIT, size=GATE_LEN, reset=GATE_RESET):
+        self.limit, self.reset = limit, reset
+        self.window = Window(size)
+        self.rejects = 0
+
+    def add(self, val, t=None):
+        med = self.window.median()
+        if med is not None and abs(val - med) > self.limit:
+            self.rejects += 1
+            if self.rejects < self.reset:
+                return None
+            self.window.clear()
+        self.rejects = 0
+        self.window.add(val)
+        return val
+
+# Constant-velocity Kalman filter, with state of distance & speed
+class Kalman(object):
+    def __init__(self, meas_var=KF_MEAS_VAR, accel_var=KF_ACCEL_VAR, reset=KF_RESET):
+        self.meas_var, self.accel_var, self.reset = meas_var, accel_var, reset
+        self.last = None
+
+    def add(self, val, t=None):
+        t = time.time() if t is None else t
+        dt = None if self.last is None else t - self.last
+        self.last = t
+        if dt is None or dt < 0 or dt > self.reset:
+            self.x, self.v = val, 0.0
+            self.p00, self.p01, self.p11 = self.meas_var, 0.0, self.accel_var
+            return val
+        # Predict
+        q = self.accel_var
+        self.x += self.v * dt
+        self.p00 += dt*(2*self.p01 + dt*self.p11) + q*dt**4/4
+        self.p01 += dt*self.p11 + q*dt**3/2
+        self.p11 += q*dt**2
+        # Update
+        s = self.p00 + self.meas_var
+        k0, k1 = self.p00/s, self.p01/s
+        err = val - self.x
+        self.x += k0 * err
+        self.v += k1 * err
+        self.p11 -= k1 * self.p01
+        self.p01 -= k0 * self.p01
+        self.p00 -= k0 * self.p00
+        return self.x
+
+# Sequence of filters; a rejected value isn't passed to later filters
+# NaN (from an invalid exchange) is always rejected
+class Pipeline(object):
+    def __init__(self, *stages):
+        self.stages = stages
+
+    def add(self, val, t=None):
+        if math.isnan(val):
+            return None
+        t = time.time() if t is None else t
+        for stage in self.stages:
+            val = stage.add(val, t)
+            if val is None:
+                break
+        return val
+
+# Pipelines for pairs of units, created when first used
+class FilterBank(object):
+    def __init__(self, factory=None):
+        self.factory = factory or default_pipeline
+        self.pipes = {}
+
+    # Add range value for a pair, return filtered value or None
+    def add(self, pair, val, t=None):
+        pipe = self.pipes.get(pair)
+        if pipe is None:
+            pipe = self.pipes[pair] = self.factory()
+        return pipe.add(val, t)
+
+# Return default pipeline: outlier gate, median, then Kalman filter
+def default_pipeline():
+    return Pipeline(Gate(), Median(), Kalman())
+
+# Return iterator for filtered values from iterable of (time, value)
+# Rejected values are skipped
+def filtered(samples, pipe=None):
+    pipe = pipe or default_pipeline()
+    for t, val in samples:
+        val = pipe.add(val, t)
+        if val is not None:
+            yield t, val
+
+if __name__ == "__main__":
+    # Filter lines of 'time value' from stdin
+    samples = ((float(a), float(b)) for a, b in (line.split()[:2] for line in sys.stdin
+                                                 if len(line.split()) >= 2))
+    for t, val in filtered(samples):
+        print("%1.3f %7.3f" % (t, val))
+
+# EOF
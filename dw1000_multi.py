@@ -0,0 +1,260 @@
+# Decawave DW1000 ranging between multiple units
+# Copyright (c) Jeremy P Bentham 2019. See iosoft.blog for details
+#
+# DS-TWR exchanges are run between pairs of units. By default all units
+# are in one RF zone, so exchanges are in separate time-slots; if RF zones
+# are given, pairs that don't share a unit or zone are run in parallel.
+# Received frames are checked, so a frame from another pair is rejected.
+
+import sys, time, asyncio
+from dw1000_async import start_units
+from dw1000_spi import parse_spif
+from dw1000_range import Frame, BLINK_MSG, BLINK_FRAME_CTRL
+from dw1000_twr import twr_dists, valid_range, MAX_RANGE
+from dw1000_capture import CaptureWriter
+from dw1000_filter import FilterBank
+from dw1000_telemetry import Telemetry, TELEMETRY_INTERVAL
+
+MAX_ERRORS  = 10    # Consecutive errors before resetting units
+
+# Statistics for a pair of units
+class PairStats(object):
+    def __init__(self, pair):
+        self.pair = pair
+        self.count = self.errors = self.fails = 0
+        self.total = 0.0
+        self.last = self.filt = None
+
+    # Add a range value (or None if failed), and optional filtered value
+    def add(self, dist, filt=None):
+        if filt is not None:
+            self.filt = filt
+        if dist is None:
+            self.errors += 1
+            self.fails += 1
+        else:
+            self.count += 1
+            self.fails = 0
+            self.total += dist
+            self.last = dist
+
+    # Return string with statistics
+    def __str__(self):
+        mean = self.total/self.count if self.count else 0
+        return "%u-%u n:%u err:%u last:%7.3f mean:%7.3f filt:%7.3f" % (self.pair[0]+1,
+               self.pair[1]+1, self.count, self.errors, self.last or 0, mean, self.filt or 0)
+
+# Ranging engine for multiple units
+# Pairs are (initiator, responder) indexes into the list of units
+# Zones is an optional list of RF zone numbers for each unit; units in
+# the same zone can hear each other, so must not transmit at the same time.
+# If not given, all units are in the same zone
+# Ranges that are negative, or beyond the maximum (metres), are rejected
+# Timestamps are saved if a capture writer is given
+# Telemetry (if any) is collected between cycles, so exchanges aren't delayed
+class Ranger(object):
+    def __init__(self, dws, pairs, zones=None, capture=None, telemetry=None,
+                 max_range=MAX_RANGE):
+        self.dws, self.pairs = dws, pairs
+        self.zones = [0]*len(dws) if zones is None else zones
+        self.capture, self.telemetry = capture, telemetry
+        self.max_range = max_range
+        self.seq = self.resets = 0
+        self.slots = make_slots(pairs, self.zones)
+        self.stats = {pair: PairStats(pair) for pair in pairs}
+        self.filters = FilterBank()
+        self.frames = []
+        for n in range(len(dws)):
+            frame = Frame(BLINK_MSG)
+            frame.values.framectrl = BLINK_FRAME_CTRL
+            frame.values.tagid = 0x0101010101010101 * ((n % 255) + 1)
+            self.frames.append(frame)
+        self.start = time.time()
+
+    # Do DS-TWR exchange between two units, return timestamps or None
+    # Each received frame must be the one just sent by the other unit
+    async def exchange(self, pair):
+        dw1, dw2 = self.dws[pair[0]], self.dws[pair[1]]
+        frame1, frame2 = self.frames[pair[0]], self.frames[pair[1]]
+        # First message
+        await dw2.start_rx()
+        await dw1.transmit(frame1.data())
+        if not frame_match(await dw2.get_rxdata(), frame1):
+            return None
+        await dw2.clear_irq()
+        # Second message
+        await dw1.start_rx()
+        await dw2.transmit(frame2.data())
+        if not frame_match(await dw1.get_rxdata(), frame2):
+            return None
+        await dw1.clear_irq()
+        (tx1, rx2), (tx2, rx1) = await asyncio.gather(dw1.txrx_times(), dw2.txrx_times())
+        # Third message
+        await dw2.start_rx()
+        await dw1.transmit(frame1.data())
+        if not frame_match(await dw2.get_rxdata(), frame1):
+            return None
+        await dw2.clear_irq()
+        (tx3, _), (_, rx3) = await asyncio.gather(dw1.txrx_times(), dw2.txrx_times())
+        return tx1, rx1, tx2, rx2, tx3, rx3
+
+    # Do exchange, update statistics, reset units if too many errors
+    async def range_pair(self, pair):
+        stats = self.stats[pair]
+        tstamps = await self.exchange(pair)
+        self.seq += 1
+        if tstamps and self.capture:
+            self.capture.add(self.seq, pair[0]+1, pair[1]+1, tstamps)
+        dist = twr_dists(*tstamps)[1] if tstamps else None
+        dist = dist if valid_range(dist, self.max_range) else None
+        stats.add(dist, None if dist is None else self.filters.add(pair, dist))
+        if stats.fails > MAX_ERRORS:
+            print("Resetting %u-%u" % (pair[0]+1, pair[1]+1))
+            self.resets += 1
+            for n in pair:
+                dw = self.dws[n]
+                await dw.run(dw.dw.softreset)
+                await dw.initialise()
+            stats.fails = 0
+        return stats.last
+
+    # Run all time-slots once, return list of (pair, distance)
+    async def run_cycle(self):
+        results = []
+        for slot in self.slots:
+            dists = await asyncio.gather(*[self.range_pair(pair) for pair in slot])
+            results += list(zip(slot, dists))
+        return results
+
+    # Run a number of cycles (forever if None), printing results
+    async def run(self, cycles=None, verbose=False):
+        n = 0
+        while cycles is None or n < cycles:
+            results = await self.run_cycle()
+            if self.telemetry:
+                await self.telemetry.poll(self.loop_metrics())
+            if verbose:
+                print(" ".join(["%u-%u:%7.3f" % (p[0]+1, p[1]+1, d or 0)
+                                for p, d in results]))
+            n += 1
+            if n%100 == 0:
+                sys.stderr.write("%1.1f/s " % self.throughput())
+                sys.stderr.flush()
+
+    # Return aggregate number of ranges per second
+    def throughput(self):
+        total = sum([s.count for s in self.stats.values()])
+        return total / max(time.time() - self.start, 1e-6)
+
+    # Return dictionary of ranging loop metrics, for telemetry
+    def loop_metrics(self):
+        vals = {"ranges_per_sec": self.throughput(), "resets": self.resets,
+                "exchanges": self.seq}
+        vals["ranges"] = sum([s.count for s in self.stats.values()])
+        vals["range_errors"] = sum([s.errors for s in self.stats.values()])
+        return vals
+
+    # Return string with statistics for each pair and SPI interface,
+    # and total throughput
+    def report(self):
+        lines = [str(self.stats[pair]) for pair in self.pairs]
+        lines += [str(dw.spi.stats) for dw in self.dws]
+        lines.append("Total %1.1f ranges/sec" % self.throughput())
+        return "\n".join(lines)
+
+# Return True if received data is the frame last sent by a unit, i.e.
+# has the same tag ID and sequence number
+def frame_match(rxdata, frame):
+    rxframe = Frame(frame.fields)
+    return (bool(rxdata) and rxframe.decode(rxdata) and
+            rxframe.values.tagid == frame.values.tagid and
+            rxframe.values.seqnum == frame.values.seqnum)
+
+# Return True if two pairs can't be run at the same time
+def pairs_conflict(p1, p2, zones=None):
+    if set(p1) & set(p2):
+        return True
+    if zones is not None:
+        return bool(set([zones[n] for n in p1]) & set([zones[n] for n in p2]))
+    return False
+
+# Allocate pairs to time-slots, so there are no conflicts within a slot
+# Pairs with most conflicts are allocated first (greedy colouring)
+def make_slots(pairs, zones=None):
+    order = sorted(pairs, key=lambda p: -sum([pairs_conflict(p, q, zones)
+                                              for q in pairs if q != p]))
+    slots = []
+    for pair in order:
+        for slot in slots:
+            if not any([pairs_conflict(pair, q, zones) for q in slot]):
+                slot.append(pair)
+                break
+        else:
+            slots.append([pair])
+    return slots
+
+# Parse pair list such as '1-2,3-4' (unit numbers starting at 1)
+def parse_pairs(s):
+    pairs = []
+    for item in s.split(','):
+        a, b = item.split('-')
+        pairs.append((int(a)-1, int(b)-1))
+    return pairs
+
+async def main(spifs, pairs, zones, verbose, capture=None, metrics_port=None,
+               interval=TELEMETRY_INTERVAL, max_range=MAX_RANGE):
+    dws = await start_units(spifs)
+    telemetry = None
+    if metrics_port:
+        telemetry = Telemetry(dws, interval)
+        await telemetry.serve(metrics_port)
+        print("Metrics on http://localhost:%u/metrics" % metrics_port)
+    ranger = Ranger(dws, pairs, zones, capture, telemetry, max_range)
+    print("%u pairs in %u slots" % (len(pairs), len(ranger.slots)))
+    try:
+        await ranger.run(verbose=verbose)
+    finally:
+        if telemetry:
+            telemetry.close()
+        print(ranger.report())
+
+if __name__ == "__main__":
+    verbose, zones, pairs, spifs, capture = False, None, None, [], None
+    metrics_port, interval, max_range = None, TELEMETRY_INTERVAL, MAX_RANGE
+    args = iter(sys.argv[1:])
+    for arg in args:
+        if arg.lower() == "-v":
+            verbose = True
+        elif arg.lower() == "-z":
+            zones = [int(z) for z in next(args).split(',')]
+        elif arg.lower() == "-r":
+            max_range = float(next(args))
+        elif arg.lower() == "-p":
+            pairs = parse_pairs(next(args))
+        elif arg.lower() == "-c":
+            capture = CaptureWriter(next(args))
+        elif arg.lower() == "-m":
+            metrics_port = int(next(args))
+        elif arg.lower() == "-i":
+            interval = float(next(args))
+        else:
+            spifs.append(parse_spif(arg))
+    if len(spifs) < 2:
+        print("Usage: dw1000_multi.py [-v] [-z 0,0,1,1] [-p 1-2,3-4] [-r metres] [-c file] "
+              "[-m port] [-i secs] [tcp:|unix:]<IP_ADDR>[:<PORT>] ...")
+        print("  -z: RF zone of each unit (default all in one zone), -p: pairs to range")
+        print("  -r: maximum range (default %g), -c: capture file" % MAX_RANGE)
+        print("  -m: HTTP port for telemetry metrics, -i: telemetry interval")
+        sys.exit(1)
+    if pairs is None:
+        pairs = [(a, b) for a in range(len(spifs)) for b in range(a+1, len(spifs))]
+    if zones is not None and len(zones) != len(spifs):
+        print("Need an RF zone for each unit")
+        sys.exit(1)
+    try:
+        asyncio.run(main(spifs, pairs, zones, verbose, capture, metrics_port, interval,
+                         max_range))
+    except KeyboardInterrupt:
+        pass
+
+# EOF
@@ -1,25 +1,43 @@
 # Decawave DW1000 ranging demo
 # Copyright (c) Jeremy P Bentham 2019. See iosoft.blog for details
 
-import sys, time
-from ctypes import sizeof, LittleEndianStructure as Structure, Union
-from ctypes import c_ubyte as U8, c_short as U16, c_ulonglong as U64
-from dw1000_regs import Reg, DW1000, msdelay
+import sys, time, atexit, struct
+from operator import attrgetter
+from dw1000_regs import Reg, DW1000, msdelay, start_trace, txrx_times_all, TX_BUFFER
 from dw1000_spi import Spi
+from dw1000_twr import twr_dists, valid_dist, tstamp_diff, TSTAMP_SEC
+from dw1000_capture import CaptureWriter
+from dw1000_filter import default_pipeline
 
-VERSION = "0.16"
+VERSION = "0.18"
 
 # Specify SPI interfaces:
 #   "UDP", "<IP_ADDR>", <PORT_NUM>
+#   "TCP", "<IP_ADDR>", <PORT_NUM>
+#   "UNIX", "<SOCKET_PATH>"
 SPIF1       = "UDP", "10.1.1.235", 1401
 SPIF2       = "UDP", "10.1.1.230", 1401
 
+# Delayed-reply ranging: time from Rx timestamp to reply Tx timestamp (sec)
+# Must allow for the Rx frame length, network latency, and Tx preamble
+REPLY_DELAY = 0.005
+
+# Field types for frame layouts (little-endian, no padding)
+U8, U16, U32, U64 = 'B', 'H', 'I', 'Q'
+
 # Blink frame with IEEE EUI-64 tag ID
 BLINK_FRAME_CTRL = 0xc5
 BLINK_MSG=(('framectrl',   U8),
            ('seqnum',      U8),
            ('tagid',       U64))
 
+# Ranging message with Rx timestamp of previous message, and own Tx timestamp
+RANGE_MSG=(('framectrl',   U8),
+           ('seqnum',      U8),
+           ('tagid',       U64),
+           ('rxtime',      U64),
+           ('txtime',      U64))
+
 MSG_FRAME_CTRL = 0xCC41
 MSG_HDR = (('framectrl',   U16),
            ('seqnum',      U8),
@@ -27,41 +45,187 @@ MSG_HDR = (('framectrl',   U16),
            ('destaddr',    U64),
            ('srceaddr',    U64))
 
-LIGHT_SPEED = 299702547.0
-TSTAMP_SEC  = 1.0 / (128 * 499.2e6)
-TSTAMP_DIST = LIGHT_SPEED * TSTAMP_SEC
+# Compiled frame layout: struct codec, and function to get field values
+# Field definitions are converted to tuples, so they can be used as a key
+class FrameLayout(object):
+    def __init__(self, fields):
+        self.fields = fields = layout_key(fields)
+        self.names = tuple([f[0] for f in fields])
+        self.codec = struct.Struct('<' + ''.join([f[1] for f in fields]))
+        self.size = self.codec.size
+        get = attrgetter(*self.names)
+        self.getter = get if len(self.names) > 1 else lambda v: (get(v),)
+
+# Layouts compiled so far, keyed by field definitions
+layouts = {}
+
+# Return compiled layout for field definitions (tuples or lists)
+def frame_layout(fields):
+    key = layout_key(fields)
+    layout = layouts.get(key)
+    if layout is None:
+        layout = layouts[key] = FrameLayout(key)
+    return layout
+
+# Return field definitions as a tuple of tuples
+def layout_key(fields):
+    return tuple([tuple(f) for f in fields])
+
+# Field values of a frame
+class FrameValues(object):
+    def __init__(self, names):
+        for name in names:
+            setattr(self, name, 0)
 
 # Class to encapsulate a message frame or header with fixed-length fields
+# Frames are encoded into a Tx buffer, after the SPI header byte
 class Frame(object):
-    def __init__(self, fields, bytes=[]):
+    def __init__(self, fields, data=None):
+        self.layout = frame_layout(fields)
         self.fields = fields
         self.seqnum = 1
-        class struct(Structure):
-            _pack_   = 1
-            _fields_ = fields
-        class union(Union):
-            _fields_ = [("values", struct), ("bytes", U8*sizeof(struct))]
-        self.u = union()
-        for n, b in enumerate(bytes[0:sizeof(struct)]):
-            self.u.bytes[n] = b
-        self.bytes, self.values = self.u.bytes, self.u.values
-
-    # Return frame data
+        self.values = FrameValues(self.layout.names)
+        self.txbuff = bytearray(self.layout.size + 1)
+        self.txbuff[0] = TX_BUFFER[0] | 0x80
+        self.txview = memoryview(self.txbuff)
+        if data is not None:
+            self.decode(data)
+
+    # Set next sequence number, encode frame, return frame data
+    # The data is a view of the Tx buffer, so is overwritten by the next
+    # call; copy it (e.g. with bytes) if it is to be kept
     def data(self):
-        self.values.seqnum = self.seqnum
+        return self.txdata()[1:]
+
+    # Set next sequence number, encode frame, return frame data with SPI
+    # header, for DW1000.transmit(prefixed=True); also a view of the buffer
+    def txdata(self):
+        self.values.seqnum = self.seqnum & 0xff
         self.seqnum += 1
-        return list(self.bytes)
+        self.layout.codec.pack_into(self.txbuff, 1, *self.layout.getter(self.values))
+        return self.txview
+
+    # Decode field values from received data (bytes, bytearray or memoryview)
+    # Returns False if too short
+    def decode(self, data):
+        if len(data) < self.layout.size:
+            return False
+        vals = self.layout.codec.unpack_from(data)
+        for name, val in zip(self.layout.names, vals):
+            setattr(self.values, name, val)
+        return True
 
     # Return string with field values
     def field_values(self, zeros=True):
-        flds = [f[0] for f in self.fields]
-        return " ".join([("%s:%x" % (f,getattr(self.values, f))) for f in flds])
+        return " ".join([("%s:%x" % (f,getattr(self.values, f))) for f in self.layout.names])
+
+# Return ranging frame for a unit
+def range_frame(unit):
+    frame = Frame(RANGE_MSG)
+    frame.values.framectrl = BLINK_FRAME_CTRL
+    frame.values.tagid = 0x0101010101010101 * unit
+    return frame
+
+# DS-TWR exchange of 3 messages, each sent as soon as the previous one has
+# been received. Returns the 6 timestamps, or None if failed
+def exchange(dw1, dw2, frame1, frame2):
+    # First message
+    dw2.start_rx()
+    dw1.transmit(frame1.txdata(), prefixed=True)
+    if not dw2.get_rxdata():
+        dw2.sys_status()
+        return None
+    dw2.clear_irq()
+    # Second message
+    dw1.start_rx()
+    dw2.transmit(frame2.txdata(), prefixed=True)
+    if not dw1.get_rxdata():
+        dw1.sys_status()
+        return None
+    dw1.clear_irq()
+    (tx1, rx2), (tx2, rx1) = txrx_times_all([dw1, dw2])
+    # Third message
+    dw2.start_rx()
+    dw1.transmit(frame1.txdata(), prefixed=True)
+    if not dw2.get_rxdata():
+        dw2.sys_status()
+        return None
+    dw2.clear_irq()
+    return tx1, rx1, tx2, rx2, dw1.tx_time(), dw2.rx_time()
+
+# DS-TWR exchange using delayed replies: each reply is sent at a fixed delay
+# after the Rx timestamp, and carries that timestamp & its own Tx timestamp,
+# so the only register read is the initiator's first Tx time (overlapped
+# with the second reply). Delay is in seconds. If that read is resent after
+# the final reply, it returns the wrong Tx time, so the exchange fails
+# Returns the 6 timestamps, or None if failed
+def delayed_exchange(dw1, dw2, frame1, frame2, delay=REPLY_DELAY):
+    delay = int(delay / TSTAMP_SEC)
+    rxframe = Frame(RANGE_MSG)
+    # Poll
+    frame1.values.rxtime = frame1.values.txtime = 0
+    dw2.start_rx()
+    dw1.clear_interrupt()
+    dw1.transmit(frame1.txdata(), rx=True, prefixed=True)
+    if not dw2.get_rxdata():
+        dw2.sys_status()
+        return None
+    # Response
+    rx1 = dw2.rx_time()
+    def make_resp(txtime):
+        frame2.values.rxtime, frame2.values.txtime = rx1, txtime
+        return frame2.data()
+    if dw2.reply_at(rx1, delay, make_resp, rx=True) is None:
+        print("Reply 1 too late")
+        return None
+    rxdata = dw1.get_rxdata()
+    if not rxdata or not rxframe.decode(rxdata):
+        dw1.sys_status()
+        return None
+    rx1, tx2 = rxframe.values.rxtime, rxframe.values.txtime
+    # Final: if the Rx time wasn't pushed with the IRQ, wait for it
+    tx, rx, reqs = dw1.post_txrx_times()
+    if not dw1.snapshot:
+        dw1.spi.wait_all(reqs)
+    rx2 = rx.reg.RX_STAMP
+    def make_final(txtime):
+        frame1.values.rxtime, frame1.values.txtime = rx2, txtime
+        return frame1.data()
+    tx3 = dw1.reply_at(rx2, delay, make_final)
+    dw1.spi.wait_all(reqs)
+    if tx3 is None:
+        print("Reply 2 too late")
+        return None
+    tx1 = tx.reg.TX_STAMP
+    if tstamp_diff(rx2, tx1) >= tstamp_diff(tx3, tx1):
+        print("Tx time read after reply 2")
+        return None
+    if not dw2.get_rxdata():
+        dw2.sys_status()
+        return None
+    dw2.clear_irq()
+    return tx1, rx1, tx2, rx2, tx3, dw2.rx_time()
 
 if __name__ == "__main__":
-    verbose = False
-    for arg in sys.argv[1:]:
+    verbose, capture, pipe, delay = False, None, None, None
+    args = iter(sys.argv[1:])
+    for arg in args:
         if arg.lower() == "-v":
             verbose = True
+        elif arg.lower() == "-t":
+            atexit.register(start_trace().dump, next(args))
+        elif arg.lower() == "-c":
+            capture = CaptureWriter(next(args))
+        elif arg.lower() == "-f":
+            pipe = default_pipeline()
+        elif arg.lower() == "-d":
+            delay = float(next(args)) / 1000.0
+        else:
+            print("Unrecognised argument '%s'" % arg)
+            print("Usage: dw1000_range.py [-v] [-t tracefile] [-c capturefile] [-f] [-d msec]")
+            print("  -f: filter ranges, -d: use delayed replies at given time after Rx (e.g. %g)"
+                  % (REPLY_DELAY * 1000))
+            sys.exit(1)
     spi1 = Spi(SPIF1, '1')
     dw1 = DW1000(spi1)
 
@@ -89,6 +253,7 @@ if __name__ == "__main__":
     blink2 = Frame(BLINK_MSG)
     blink2.values.framectrl = BLINK_FRAME_CTRL
     blink2.values.tagid = 0x0202020202020202
+    range1, range2 = range_frame(1), range_frame(2)
 
     errors = count = 0
     while True:
@@ -102,52 +267,22 @@ if __name__ == "__main__":
             dw2.initialise()
             errors = 0
 
-        # First message
-        txdata = blink1.data()
-        dw2.start_rx()
-        dw1.set_txdata(txdata)
-        dw1.start_tx()
-        rxdata = dw2.get_rxdata()
-        if not rxdata:
-            print(dw2.sys_status())
-            continue
-        dw2.clear_irq()
-
-        # Second message
-        txdata = blink2.data()
-        dw1.start_rx()
-        dw2.set_txdata(txdata)
-        dw2.start_tx()
-        rxdata = dw1.get_rxdata()
-        if not rxdata:
-            print(dw1.sys_status())
+        if delay is None:
+            tstamps = exchange(dw1, dw2, blink1, blink2)
+        else:
+            tstamps = delayed_exchange(dw1, dw2, range1, range2, delay)
+        if not tstamps:
             continue
-        dw1.clear_irq()
-        dt1 = dw1.rx_time() - dw1.tx_time()
-        dt2 = dw2.tx_time() - dw2.rx_time()
-        tx1, rx1 = dw1.tx_time(), dw2.rx_time()
-        tx2, rx2 = dw2.tx_time(), dw1.rx_time()
-
-        # Third message
-        txdata = blink1.data()
-        dw2.start_rx()
-        dw1.set_txdata(txdata)
-        dw1.start_tx()
-        rxdata = dw2.get_rxdata()
-        if not rxdata:
-            print(dw2.sys_status())
-            continue
-        dw2.clear_irq()
 
         # Time calculation
-        tx3, rx3 = dw1.tx_time(), dw2.rx_time()
-        round1 = rx2 - tx1
-        round2 = rx3 - tx2
-        reply1 = tx2 - rx1
-        reply2 = tx3 - rx2
-        t1 = ((dt1 - dt2) / 2)
-        t2 = ((round1 * round2) - (reply1 * reply2)) / (round1 + round2 + reply1 + reply2)
-        print("%7.3f %7.3f" % (t1*TSTAMP_DIST, t2*TSTAMP_DIST))
+        tx1, rx1, tx2, rx2, tx3, rx3 = tstamps
+        dists = twr_dists(tx1, rx1, tx2, rx2, tx3, rx3)
+        if not valid_dist(dists[1]):
+            continue
+        filt = pipe.add(dists[1]) if pipe else None
+        print("%7.3f %7.3f" % dists + ("" if filt is None else " %7.3f" % filt))
+        if capture:
+            capture.add(count, 1, 2, (tx1, rx1, tx2, rx2, tx3, rx3))
         errors = 0
 
         # Print message count
@@ -2,9 +2,13 @@
 # See DW1000 User Manual, version 2.11
 # Copyright (c) Jeremy P Bentham 2019. See iosoft.blog for details
 
-from ctypes import LittleEndianStructure as Structure, Union
 from ctypes import c_uint as U32, c_ulonglong as U64
-import time
+from array import array
+import time, struct
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 # Default values
 DEF_PAN         = 10    # PAN ID
@@ -19,6 +23,25 @@ LONG_FRAMES     = False # Enable 1023-byte frames (standard is 127)
 RX_AUTO_EN      = False # Auto enable Rx after Tx
 AUTO_ACK        = False # Automatically acknowledge transmission
 USE_INTERRUPT   = True  # Use IRQ line
+USE_MACROS      = True  # Use command sequences stored on SPI server
+IRQ_READOUT     = True  # Server reads Rx registers when IRQ occurs
+RX_READOUT_LEN  = 32    # Number of Rx buffer bytes read on IRQ
+
+# Numbers of command sequences stored on SPI server
+MACRO_TX        = 1     # Load Tx buffer, set frame length, start Tx
+MACRO_IRQ_READ  = 2     # Registers read when IRQ occurs
+
+# Registers read by server when IRQ occurs (followed by Rx buffer)
+IRQ_READ_REGS   = ('SYS_STATUS', 'RX_FINFO', 'RX_TIME1')
+
+# Register write trace: number of entries, and binary file header
+TRACE_SIZE      = 65536
+TRACE_MAGIC     = b'DWTR'
+TRACE_HDR       = struct.Struct('<4sII')    # Magic, size, count
+
+# Accumulator (channel impulse response) memory
+ACC_SAMPLE      = struct.Struct('<hh')  # Real & imaginary parts of each sample
+ACC_SKIP        = 1     # Dummy bytes at start of each accumulator read
 
 # DW1000 register addr, length, sub-register addr, and fields
 DEV_ID    = 0x0, 4, None,(("REV",        U32, 4), ("VER",        U32, 4),
@@ -266,79 +289,338 @@ TX_PWRS_DUMB   = {1:(0x75757575,0x67676767), 2:(0x75757575,0x67676767),
                   5:(0x48484848,0x85858585), 7:(0x92929292,0xD1D1D1D1)}
 TX_PWRS        = TX_PWRS_SMRT if SMART_TX_POWER else TX_PWRS_DUMB
 
+# Mask for 64-bit register values
+U64_MASK       = (1 << 64) - 1
+
+# Masks for 40-bit timestamps, and delayed Tx/Rx time (low 9 bits ignored)
+TSTAMP_MASK    = (1 << 40) - 1
+DX_TIME_MASK   = TSTAMP_MASK & ~0x1ff
+
 # Enable RXPHE, RXFCG, RXFCE, RXRFSL, RXRFTO, RXSFDTO, AFFREJ
 SYS_MASK_VAL   = 0x2403D000
 
-# Dictionary to track register values (for debugging)
-regvals = {}
+# Registers changed by the device, or with self-clearing bits; never cached
+VOLATILE_REGS = ('SYS_TIME', 'TX_BUFFER', 'SYS_CTRL', 'SYS_STATUS', 'RX_FINFO',
+    'RX_BUFFER', 'RX_FQUAL', 'RX_TTCKI', 'RX_TTCKO', 'RX_TIME1', 'RX_TIME2',
+    'TX_TIME1', 'TX_TIME2', 'AGC_STAT1', 'EC_RXTC', 'EC_GOLP', 'ACC_MEM',
+    'GPIO_ISEN', 'GPIO_ICLR', 'GPIO_RAW', 'DRX_CAR_INT', 'RXPACC_NOSAT',
+    'RF_STATUS', 'TC_SARC', 'TC_SARL', 'TC_SARW', 'TC_PG_CTRL', 'TC_PG_STATUS',
+    'AON_CTRL', 'AON_RDAT', 'OTP_CTRL', 'OTP_STATUS', 'OTP_RDAT', 'OTP_SRDAT',
+    'OTP_SF', 'LDE_PPINDX', 'LDE_PPAMPL', 'EVC_CTRL', 'EVC_PHE', 'EVC_RSE',
+    'EVC_FCG', 'EVC_FCE', 'EVC_FFR', 'EVC_OVR', 'EVC_STO', 'EVC_PTO', 'EVC_FWTO',
+    'EVC_TXFS', 'EVC_HPW', 'EVC_TPW')
+
+# Register write trace (for debugging), disabled if None
+# Writes are added by the SPI interface, so include raw transfers, stored
+# sequences and bulk writes, as well as Reg.write
+trace = None
+
+# Ring buffer of register writes: time, register ID, sub-address & value
+class RegTrace(object):
+    def __init__(self, size=TRACE_SIZE):
+        self.size, self.count = size, 0
+        self.times = array('d', bytes(8*size))
+        self.ids = array('B', bytes(size))
+        self.subs = array('H', bytes(2*size))
+        self.values = array('Q', bytes(8*size))
+
+    # Add a register write
+    def add(self, id, sub, value):
+        n = self.count % self.size
+        self.times[n] = time.time()
+        self.ids[n], self.subs[n], self.values[n] = id, sub or 0, value & U64_MASK
+        self.count += 1
+
+    # Return list of indexes of stored entries, oldest first
+    def order(self):
+        if self.count <= self.size:
+            return range(self.count)
+        n = self.count % self.size
+        return list(range(n, self.size)) + list(range(n))
+
+    # Return list of (time, name, value) for stored entries, oldest first
+    def records(self):
+        names = {}
+        for name, rdef in REGDEFS.items():
+            names.setdefault((rdef.id, rdef.sub or 0), name)
+        return [(self.times[n], names.get((self.ids[n], self.subs[n]),
+                 "%02X:%X" % (self.ids[n], self.subs[n])), self.values[n])
+                for n in self.order()]
+
+    # Save entries to binary file, oldest first: header, then arrays of
+    # times, IDs, sub-addresses & values
+    def dump(self, fname):
+        order = self.order()
+        with open(fname, "wb") as f:
+            f.write(TRACE_HDR.pack(TRACE_MAGIC, self.size, len(order)))
+            for arr in (self.times, self.ids, self.subs, self.values):
+                array(arr.typecode, [arr[n] for n in order]).tofile(f)
+
+    # Load entries from binary file
+    @classmethod
+    def load(cls, fname):
+        with open(fname, "rb") as f:
+            magic, size, count = TRACE_HDR.unpack(f.read(TRACE_HDR.size))
+            if magic != TRACE_MAGIC:
+                raise ValueError("Not a register trace file")
+            tr = cls(size)
+            for arr in (tr.times, tr.ids, tr.subs, tr.values):
+                data = array(arr.typecode)
+                data.fromfile(f, count)
+                arr[:count] = data
+            tr.count = count
+        return tr
+
+# Add an SPI write (address header & data) to the trace, if enabled
+# Only the first 8 data bytes of a longer write (e.g. TX_BUFFER) are kept
+def trace_write(txdata):
+    if trace and len(txdata) > 1 and txdata[0] & 0x80:
+        id, sub, hlen = hdr_addr(txdata)
+        trace.add(id, sub, int.from_bytes(bytes(txdata[hlen:hlen+8]), 'little'))
+
+# Start tracing register writes, return trace object
+def start_trace(size=TRACE_SIZE):
+    global trace
+    trace = RegTrace(size)
+    return trace
+
+# Stop tracing register writes
+def stop_trace():
+    global trace
+    trace = None
+
+# Precompiled register layout, with field shift & mask tables
+class RegDef(object):
+    def __init__(self, name, regdef):
+        self.name = name
+        self.id, self.len, self.sub, self.fields = regdef
+        self.shifts, self.masks = {}, {}
+        shift = 0
+        for f in self.fields:
+            self.shifts[f[0]], self.masks[f[0]] = shift, (1 << f[2]) - 1
+            shift += f[2]
+        self.names = [f[0] for f in self.fields if not f[0].startswith('X')]
+        self.rd_hdr = addr_hdr(self.id, self.sub)
+        self.wr_hdr = addr_hdr(self.id, self.sub, True)
+        self.key = self.id, self.sub
+        self.volatile = name in VOLATILE_REGS
+
+# Return 1, 2 or 3-byte SPI header for register ID & optional sub-address
+def addr_hdr(id, sub=None, write=False):
+    hdr = ([id] if sub is None else
+           [0x40+id, sub] if sub < 0x80 else
+           [0x40+id, 0x80+(sub&0x7f), sub>>7])
+    hdr[0] |= 0x80 if write else 0
+    return hdr
+
+# Return register ID, sub-address (None if absent) & length of an SPI header
+def hdr_addr(data):
+    id = data[0] & 0x3f
+    if not data[0] & 0x40:
+        return id, None, 1
+    if not data[1] & 0x80:
+        return id, data[1], 2
+    return id, (data[1] & 0x7f) | (data[2] << 7), 3
+
+# Return True if a module-level value is a register definition
+def is_regdef(val):
+    return (isinstance(val, tuple) and len(val)==4 and isinstance(val[0], int) and
+            isinstance(val[1], int) and isinstance(val[3], tuple))
+
+# Table of all register layouts, compiled once at import
+REGDEFS = {name: RegDef(name, val) for name, val in list(globals().items())
+           if is_regdef(val)}
+
+# Attribute view of register fields, e.g. Reg('SYS_STATUS').reg.IRQS
+class RegFields(object):
+    __slots__ = ('_reg',)
+    def __init__(self, reg):
+        object.__setattr__(self, '_reg', reg)
+    def __getattr__(self, field):
+        if field not in self._reg.rdef.shifts:
+            raise AttributeError(field)
+        return self._reg.get(field)
+    def __setattr__(self, field, val):
+        self._reg.set(field, val)
 
 # DW1000 register class
 class Reg(object):
     def __init__(self, regdef, val=0):
+        self.rdef = REGDEFS[regdef]
         self.name, self.value = regdef, val
-        self.id, self.len, self.sub, self.fields = globals()[regdef]
-        class struct(Structure):
-            _fields_ = self.fields
-        class union(Union):
-            _fields_ = [("reg", struct), ("value", U64)]
-        self.u = union()
-        self.u.value = val
-        self.reg = self.u.reg
+        self.id, self.len, self.sub, self.fields = (self.rdef.id, self.rdef.len,
+                                                    self.rdef.sub, self.rdef.fields)
+        self.reg = RegFields(self)
+
+    # Load a new value, so an instance can be re-used
+    def load(self, val=0):
+        self.value = val
+        return self
 
     # Return the 1, 2 or 3-byte register address header
     def addr_hdr(self):
-        return([self.id] if self.sub is None else
-               [0x40+self.id, self.sub] if self.sub < 0x80 else
-               [0x40+self.id, 0x80+(self.sub&0x7f), self.sub>>7])
+        return list(self.rdef.rd_hdr)
 
     # Read a register value (optionally specify number of bytes)
+    # If the SPI interface is batching, the value is set when it is flushed
     def read(self, spi, nbytes=None):
         nbytes = self.len if nbytes is None else nbytes
-        hdr = self.addr_hdr()
-        msg = nbytes*[0]
-        resp = spi.xfer(hdr+msg)
-        self.value = 0
-        for n,b in enumerate(resp[len(hdr):]):
-            self.value += b << (n*8)
-        self.u.value = self.value
+        shadow = None if self.rdef.volatile or nbytes!=self.len else spi.shadow
+        spi.xfer(self.rdef.rd_hdr + nbytes*[0],
+                 lambda resp: self.decode(resp, shadow))
+        return self
+
+    # Decode register value from SPI read response, optionally save in cache
+    def decode(self, resp, shadow=None):
+        self.value = int.from_bytes(bytes(resp[len(self.rdef.rd_hdr):]), 'little')
+        if shadow is not None:
+            shadow[self.rdef.key] = self.value
         return self
 
     # Write a register value (optionally specify number of bytes)
     def write(self, spi, nbytes=None):
         nbytes = self.len if nbytes is None else nbytes
-        hdr = self.addr_hdr()
-        hdr[0] |= 0x80
-        msg = nbytes*[0]
-        value = self.value
-        for n in range(0, nbytes):
-            msg[n] = value & 0xff
-            value >>= 8
-        spi.xfer(hdr+msg)
-        if self.name not in regvals:
-            regvals[self.name] = []
-        regvals[self.name].append(self.value)
+        value = self.value & ((1 << (nbytes*8)) - 1)
+        spi.xfer(self.rdef.wr_hdr + self.encode(nbytes))
+        if not self.rdef.volatile:
+            if nbytes == self.len:
+                spi.shadow[self.rdef.key] = value
+            else:
+                spi.shadow.pop(self.rdef.key, None)
         return self
 
+    # Return list of data bytes for register value
+    def encode(self, nbytes=None):
+        nbytes = self.len if nbytes is None else nbytes
+        value = self.value & ((1 << (nbytes*8)) - 1)
+        return list(value.to_bytes(nbytes, 'little'))
+
+    # Get a field within a register
+    def get(self, field):
+        return (self.value >> self.rdef.shifts[field]) & self.rdef.masks[field]
+
     # Set a field within a register
     def set(self, field, val):
-        if hasattr(self.reg, field):
-            setattr(self.reg, field, val)
+        rdef = self.rdef
+        if field in rdef.shifts:
+            shift, mask = rdef.shifts[field], rdef.masks[field]
+            self.value = ((self.value & ~(mask << shift)) |
+                          ((int(val) & mask) << shift)) & U64_MASK
         else:
             print("Unknown attribute: '%s'" % field)
-        self.value = self.u.value
         return self
 
     # Return string with field values, optionally including zero values
     def field_vals(self, zeros=True):
-        flds = [f[0] for f in self.fields if not f[0].startswith('X')]
-        return " ".join([("%s:%x" % (f,getattr(self.reg, f))) for f in flds
-                         if zeros or getattr(self.reg, f)])
+        vals = [(f, self.get(f)) for f in self.rdef.names]
+        return " ".join([("%s:%x" % (f,v)) for f,v in vals if zeros or v])
+
+# Configuration for a channel, data rate, PRF & preamble length
+# The register values are compiled once into an image, which is a tuple of
+# (register name, value) in write order; instances are cached and immutable
+class Config(object):
+    __slots__ = ('params', 'image')
+    def __init__(self, chan=DEF_CHAN, rate=DEF_RATE, prf=DEF_PULSE_FREQ, plen=DEF_PREAM_LEN):
+        object.__setattr__(self, 'params', (chan, rate, prf, plen))
+        object.__setattr__(self, 'image', config_image(chan, rate, prf, plen))
+
+    def __setattr__(self, name, val):
+        raise AttributeError("Config is immutable")
+
+    # Return configuration with some parameters changed
+    def replace(self, chan=None, rate=None, prf=None, plen=None):
+        new = [old if val is None else val for old, val in
+               zip(self.params, (chan, rate, prf, plen))]
+        return get_config(*new)
+
+    # Return list of registers with values that differ from a shadow cache
+    def changes(self, shadow):
+        return [Reg(name, val) for name, val in self.image
+                if shadow.get(REGDEFS[name].key) != val]
+
+    def __repr__(self):
+        return "Config(chan=%u, rate=%u, prf=%u, plen=%u)" % self.params
+
+# Cache of compiled configurations
+CONFIGS = {}
+
+# Return compiled configuration, creating it if not in cache
+def get_config(chan=DEF_CHAN, rate=DEF_RATE, prf=DEF_PULSE_FREQ, plen=DEF_PREAM_LEN):
+    key = chan, rate, prf, plen
+    cfg = CONFIGS.get(key)
+    if cfg is None:
+        cfg = CONFIGS[key] = Config(*key)
+    return cfg
+
+# Return register image for a configuration
+def config_image(chan, rate, prf, plen):
+    pcode = PREAM_CODES[chan][prf==64]
+  # Select required events
+    regs = [Reg('SYS_MASK', SYS_MASK_VAL)]
+  # System config reg
+    r = Reg('SYS_CFG').set('DIS_STXP', 0 if SMART_TX_POWER else 1)
+    r.set('DIS_DRXB', 0 if RX_DOUBLE_BUFF else 1)
+    r.set('PHR_MODE', 3 if LONG_FRAMES else 0)
+    r.set('RXAUTR', RX_AUTO_EN).set('AUTOACK', AUTO_ACK)
+    regs.append(r.set('RXM110K', rate==110).set('HIRQ_POL', 1))
+  # Leading edge detection
+    regs.append(Reg('LDE_REPC', PCODE_REPCS[pcode] >> (3*(rate==110))))
+    regs.append(Reg('LDE_CFG1').set('NTM', 0xd).set('PMULT', 3))
+    regs.append(Reg('LDE_CFG2', 0x1607 if prf==16 else 0x0607))
+  # Frequency synthesiser
+    regs.append(Reg('FS_PLLCFG', FS_PLLCFGS[chan]))
+    regs.append(Reg('FS_XTALT', 0x72))
+  # Channel selection
+    regs.append(Reg('RF_RXCTRLH', 0xbc if (chan==4 or chan==7) else 0xd8))
+    regs.append(Reg('RF_TXCTRL', CHAN_RF_TXCTRL[chan]))
+  # Digital tuning
+    regs.append(Reg('DRX_TUNE0b', 0x16 if rate==110 else 6 if rate==850 else 1))
+    regs.append(Reg('DRX_TUNE1a', 0x87 if prf==16 else 0x8d))
+    regs.append(Reg('DRX_TUNE1b', 0x64 if rate==110 and plen>1024 else
+                                  0x10 if rate==6800 and plen==64 else 0x20))
+    regs.append(Reg('DRX_TUNE2', DRX_TUNE2S[PAC_SIZES[plen]][prf==64]))
+    regs.append(Reg('DRX_TUNE4H', 0x10 if plen==64 else 0x28))
+    regs.append(Reg('AGC_TUNE1', 0x8870 if prf==16 else 0x889b))
+    regs.append(Reg('AGC_TUNE2', 0x2502A907))
+    regs.append(Reg('AGC_TUNE3', 0x0035))
+  # Set channels and preamble code
+    r = Reg('CHAN_CTRL').set('TX_CHAN', chan).set('RX_CHAN', chan)
+    r.set('RXPRF', PULSE_FREQS[prf]).set('TX_PCODE', pcode)
+    regs.append(r.set('RX_PCODE', pcode))
+  # Set transmit frame control
+    r = Reg('TX_FCTRL').set('TXBR', TRX_RATES[rate])
+    r.set('TXPRF', PULSE_FREQS[prf]).set('PE', PREAM_LEN_PE[plen])
+    regs.append(r.set('TXPSR', PREAM_LEN_PSR[plen]).set('TR', 1))
+  # Set Tx power
+    regs.append(Reg('TC_PGDELAY', CHAN_TC_PGDELAY[chan]))
+    regs.append(Reg('TX_POWER', TX_PWRS[chan][prf==64]))
+    return tuple((r.name, r.value & ((1 << (8*r.len)) - 1)) for r in regs)
 
 # DW1000 chip class
 class DW1000(object):
     def __init__(self, spi):
         self.spi = spi
         self.eui = None
+        self.config = None
+        self.use_macros = USE_MACROS
+        self.snapshot = None
+        self.resets = 0     # Number of resets, when device state was lost
+
+    # Return register with value from shadow cache; read device if not cached
+    # If batching, any queued transfers are sent before the read
+    def shadow_reg(self, name):
+        r = Reg(name)
+        val = self.spi.shadow.get(r.rdef.key)
+        if val is None:
+            r.read(self.spi)
+            self.spi.sync()
+            return r
+        return r.load(val)
+
+    # Discard shadow register values, e.g. after reset
+    def invalidate(self):
+        self.spi.shadow.clear()
+        self.resets += 1
 
     # Hardware reset
     def reset(self):
@@ -346,17 +628,22 @@ class DW1000(object):
         msdelay(1)
         self.spi.reset(False)
         msdelay(10)
+        self.invalidate()
         Reg('DEV_ID').read(self.spi)
 
     # Soft reset
     def softreset(self):
+        self.invalidate()
         Reg('DEV_ID').read(self.spi)
         r = Reg('PMSC_CTRL0').read(self.spi)
         r.set('SYSCLKS', 1).write(self.spi)
         msdelay(5)
+        self.spi.begin()
         r.set('SOFTRESET', 0).write(self.spi)
         r.set('SOFTRESET', 0xf).write(self.spi)
         r.set('SYSCLKS', 0).write(self.spi)
+        self.spi.flush()
+        self.invalidate()
         msdelay(5)
 
     # Disable Tx and Rx
@@ -370,26 +657,28 @@ class DW1000(object):
 
     # Initialise Dw1000
     def initialise(self, chan=DEF_CHAN, rate=DEF_RATE, prf=DEF_PULSE_FREQ, plen=DEF_PREAM_LEN):
-      # Get preamble code
-        pcode = PREAM_CODES[chan][prf==64]
       # Soft reset, read OTP
         self.softreset()
         self.read_otp(4)
 
       # Set leading-edge detection (LDE)
-        r = Reg('PMSC_CTRL0').read(self.spi)
+        r = self.shadow_reg('PMSC_CTRL0')
         r.set('SYSCLKS', 1).write(self.spi)
         msdelay(5)
+        self.spi.begin()
         Reg('EC_CTRL').set('PLLLDT', 1).write(self.spi)
         Reg('OTP_SF').set('LDO_KICK', 1).write(self.spi)
         Reg('OTP_CTRL', 0x8000).write(self.spi)
+        self.spi.flush()
         msdelay(5)
+        self.spi.begin()
         r.set('GPDCE', 1).set('KHZCLKEN', 1).write(self.spi)
         r.set('SYSCLKS', 0).write(self.spi)
+        self.spi.flush()
         msdelay(5)
 
-      # Select required events
-        Reg('SYS_MASK', SYS_MASK_VAL).write(self.spi)
+      # Send register settings in batches, so as to minimise network traffic
+        self.spi.begin()
       # Leading edge detection
         r = Reg('PMSC_CTRL1').set('PKTSEQ', 0xe7).set('LDERUNE', 1)
       # Enable slow clock, Rx & Tx LED pins
@@ -398,76 +687,176 @@ class DW1000(object):
       # Set LED blink time, and blink LEDs
         r = Reg('PMSC_LEDC').set('BLINK_TIM', 10)
         r.set('BLINKEN', 1).write(self.spi)
+        self.spi.flush()
         self.blink_leds()
+        self.spi.begin()
       # Clear & enable event counters
         r = Reg('EVC_CTRL').set('EVC_CLR', 1).write(self.spi)
         r.set('EVC_CLR', 1).set('EVC_EN', 1).write(self.spi)
-      # System config reg
-        r = Reg('SYS_CFG').set('DIS_STXP', 0 if SMART_TX_POWER else 1)
-        r.set('DIS_DRXB', 0 if RX_DOUBLE_BUFF else 1)
-        r.set('PHR_MODE', 3 if LONG_FRAMES else 0)
-        r.set('RXAUTR', RX_AUTO_EN).set('AUTOACK', AUTO_ACK)
-        r.set('RXM110K', rate==110).set('HIRQ_POL', 1).write(self.spi)
-      # Leading edge detection
-        Reg('LDE_REPC', PCODE_REPCS[pcode] >> (3*(rate==110))).write(self.spi)
-        Reg('LDE_CFG1').set('NTM', 0xd).set('PMULT', 3).write(self.spi)
-        Reg('LDE_CFG2', 0x1607 if prf==16 else 0x0607).write(self.spi)
-      # Frequency synthesiser
-        Reg('FS_PLLCFG', FS_PLLCFGS[chan]).write(self.spi)
-        Reg('FS_XTALT', 0x72).write(self.spi)
-      # Channel selection
-        Reg('RF_RXCTRLH', 0xbc if (chan==4 or chan==7) else 0xd8).write(self.spi)
-        Reg('RF_TXCTRL', CHAN_RF_TXCTRL[chan]).write(self.spi)
-      # Digital tuning
-        Reg('DRX_TUNE0b', 0x16 if rate==110 else 6 if rate==850 else 1).write(self.spi)
-        Reg('DRX_TUNE1a', 0x87 if prf==16 else 0x8d).write(self.spi)
-        Reg('DRX_TUNE1b', 0x64 if rate==110 and plen>1024 else
-                          0x10 if rate==6800 and plen==64 else 0x20).write(self.spi)
-        Reg('DRX_TUNE2', DRX_TUNE2S[PAC_SIZES[plen]][prf==64]).write(self.spi)
-        Reg('DRX_TUNE4H', 0x10 if plen==64 else 0x28).write(self.spi)
-        Reg('AGC_TUNE1', 0x8870 if prf==16 else 0x889b).write(self.spi)
-        Reg('AGC_TUNE2', 0x2502A907).write(self.spi)
-        Reg('AGC_TUNE3', 0x0035).write(self.spi)
-      # Set channels and preamble code
-        r = Reg('CHAN_CTRL').set('TX_CHAN', chan).set('RX_CHAN', chan)
-        r.set('RXPRF', PULSE_FREQS[prf]).set('TX_PCODE', pcode)
-        r.set('RX_PCODE', pcode).write(self.spi)
-      # Set transmit frame control
-        r = Reg('TX_FCTRL').set('TXBR', TRX_RATES[rate])
-        r.set('TXPRF', PULSE_FREQS[prf]).set('PE', PREAM_LEN_PE[plen])
-        r.set('TXPSR', PREAM_LEN_PSR[plen]).set('TR', 1).write(self.spi)
-      # Set Rx & Tx delays, and Tx power
+      # Registers for channel, data rate, PRF & preamble length
+        self.apply_config(get_config(chan, rate, prf, plen))
+      # Set Rx & Tx delays
         Reg('LDE_RXANTD').write(self.spi)
         Reg('TX_ANTD').write(self.spi)
-        Reg('TC_PGDELAY', CHAN_TC_PGDELAY[chan]).write(self.spi)
-        Reg('TX_POWER', TX_PWRS[chan][prf==64]).write(self.spi)
+        self.spi.flush()
+      # Get server to read Rx registers when IRQ occurs
+        if IRQ_READOUT and self.use_macros:
+            self.define_readout()
       # Clear status flags
         self.clear_status()
 
+    # Write the registers of a configuration that differ from the known
+    # device state, in one transfer; return the number of registers written
+    def apply_config(self, cfg):
+        regs = cfg.changes(self.spi.shadow)
+        if regs:
+            self.spi.begin()
+            for r in regs:
+                r.write(self.spi)
+            self.spi.flush()
+        self.config = cfg
+        return len(regs)
+
+    # Change some of the configuration parameters (e.g. for channel hopping),
+    # with Tx & Rx disabled; return the number of registers written
+    def configure(self, chan=None, rate=None, prf=None, plen=None):
+        cfg = (self.config or get_config()).replace(chan, rate, prf, plen)
+        self.spi.begin()
+        self.idle()
+        n = self.apply_config(cfg)
+        self.spi.flush()
+        return n
+
     # Set LEDs on for 85 msec
     def blink_leds(self):
-        r = Reg('PMSC_LEDC').read(self.spi).set('BLNKNOW', 0xf).write(self.spi)
+        self.spi.begin()
+        r = self.shadow_reg('PMSC_LEDC').set('BLNKNOW', 0xf).write(self.spi)
         r.set('BLNKNOW', 0).write(self.spi)
+        self.spi.flush()
 
     # Send data to Tx buffer
-    def set_txdata(self, data):
-        hdr = [TX_BUFFER[0] + 0x80]
-        self.spi.xfer(hdr + data)
-        Reg('TX_FCTRL').read(self.spi).set('TFLEN', len(data)+2).write(self.spi)
+    # If 'prefixed', the data starts with the Tx buffer SPI header (as from
+    # Frame.txdata), so is sent without copying
+    def set_txdata(self, data, prefixed=False):
+        nbytes = len(data) - 1 if prefixed else len(data)
+        self.spi.begin()
+        self.spi.xfer(data if prefixed else [TX_BUFFER[0] + 0x80] + list(data))
+        self.shadow_reg('TX_FCTRL').set('TFLEN', nbytes+2).write(self.spi)
+        self.spi.flush()
 
     # Get Tx timestamp
     def tx_time(self):
         return Reg('TX_TIME1').read(self.spi).reg.TX_STAMP
 
+    # Get Tx and Rx timestamps in a single transfer
+    def txrx_times(self):
+        tx, rx, reqs = self.post_txrx_times()
+        self.spi.wait_all(reqs)
+        return tx.reg.TX_STAMP, rx.reg.RX_STAMP
+
+    # Start reading Tx and Rx timestamps, without waiting for the response
+    # Returns the registers, which are valid after spi.wait_all(requests)
+    def post_txrx_times(self):
+        self.spi.begin()
+        tx = Reg('TX_TIME1').read(self.spi)
+        rx = self.snapshot['RX_TIME1'] if self.snapshot else Reg('RX_TIME1').read(self.spi)
+        return tx, rx, self.spi.post()
+
     # Transmit with optional delay, and enabling receiver afterwards
     def start_tx(self, delay=None, rx=False):
         ctrl = Reg('SYS_CTRL')
         if delay is not None:
-            t = Reg('SYS_TIME').read(self.spi).value + delay
+            t = Reg('SYS_TIME').read(self.spi)
+            self.spi.sync()
+            t = t.value + delay
             Reg('DX_TIME', t).write(self.spi)
             ctrl.set('TXDLYS', 1)
         ctrl.set('TXSTRT', 1).set('WAIT4RESP', rx).write(self.spi)
 
+    # Transmit at a fixed delay (in timestamp units) after a device timestamp,
+    # e.g. the Rx time of a message, without reading SYS_TIME. The Tx timestamp
+    # is predicted, and passed to the 'make' function, which returns the frame
+    # data, so the timestamp can be sent in the frame. Interrupt status is
+    # cleared, and the data & delayed start are written, in a single transfer
+    # if the status was pushed with the IRQ, and TX_FCTRL is in the shadow
+    # cache; otherwise they are read first, in a separate transfer.
+    # Returns Tx timestamp, or None if the time had passed before the start
+    def reply_at(self, tstamp, delay, make, rx=False):
+        dx = (tstamp + delay) & DX_TIME_MASK
+        txtime = (dx + self.shadow_reg('TX_ANTD').value) & TSTAMP_MASK
+        data = make(txtime)
+        self.spi.begin()
+        self.clear_irq()
+        self.clear_interrupt()
+        self.set_txdata(data)
+        Reg('DX_TIME', dx).write(self.spi)
+        Reg('SYS_CTRL').set('TXDLYS', 1).set('TXSTRT', 1).set('WAIT4RESP', rx).write(self.spi)
+        status = Reg('SYS_STATUS').read(self.spi)
+        self.spi.flush()
+        if status.reg.HPDWARN:
+            self.spi.begin()
+            self.cancel_tx()
+            self.spi.flush()
+            return None
+        return txtime
+
+    # Cancel a delayed transmission, and clear the warning flag
+    # The writes are queued if batching, so can be sent in one transfer
+    def cancel_tx(self):
+        self.idle()
+        Reg('SYS_STATUS').set('HPDWARN', 1).write(self.spi)
+
+    # Load Tx buffer and start transmission in a single transfer
+    # If no delay, use the stored sequence on the server if possible; it is
+    # only redefined if the server says it isn't defined, not on a timeout,
+    # as the frame may already have been sent. The TX_FCTRL shadow value
+    # is only kept if every block in the sequence got a reply
+    # Data may be prefixed with the Tx buffer SPI header, as for set_txdata
+    def transmit(self, data, delay=None, rx=False, prefixed=False):
+        if self.use_macros and delay is None:
+            frame = memoryview(data)[1:] if prefixed else data
+            fctrl = self.shadow_reg('TX_FCTRL').set('TFLEN', len(frame)+2)
+            ctrl = Reg('SYS_CTRL').set('TXSTRT', 1).set('WAIT4RESP', rx)
+            params = frame, fctrl.encode(), ctrl.encode()
+            resps = self.spi.run(MACRO_TX, params)
+            if resps is None and self.define_macros():
+                resps = self.spi.run(MACRO_TX, params)
+            if resps is not None:
+                if resps and all(resps):
+                    self.spi.shadow[fctrl.rdef.key] = fctrl.value
+                else:
+                    self.spi.shadow.pop(fctrl.rdef.key, None)
+                return
+        self.spi.begin()
+        self.set_txdata(data, prefixed)
+        self.start_tx(delay, rx)
+        self.spi.flush()
+
+    # Store command sequences on the server
+    # If not supported by the server, don't try to use them again
+    def define_macros(self):
+        self.use_macros = self.spi.define(MACRO_TX, ((0, [TX_BUFFER[0] + 0x80]),
+                                                     (1, REGDEFS['TX_FCTRL'].wr_hdr),
+                                                     (2, REGDEFS['SYS_CTRL'].wr_hdr)))
+        return self.use_macros
+
+    # Set registers to be read by the server when an IRQ occurs
+    def define_readout(self):
+        blocks = [REGDEFS[name].rd_hdr + REGDEFS[name].len*[0] for name in IRQ_READ_REGS]
+        blocks.append([RX_BUFFER[0]] + RX_READOUT_LEN*[0])
+        self.use_macros = self.spi.define(MACRO_IRQ_READ, blocks)
+        return self.use_macros and self.spi.irq_readout(MACRO_IRQ_READ)
+
+    # Return dictionary of registers pushed by server with IRQ, or None
+    # The Rx buffer data (without header) is in 'RX_BUFFER'
+    def irq_snapshot(self):
+        data = self.spi.irq_data
+        if len(data) != len(IRQ_READ_REGS)+1 or not all(data):
+            return None
+        snap = {name: Reg(name).decode(resp) for name, resp in zip(IRQ_READ_REGS, data)}
+        snap['RX_BUFFER'] = memoryview(data[-1])[1:]
+        return snap
+
     # Enable receiver
     def start_rx(self):
         self.clear_interrupt()
@@ -501,9 +890,17 @@ class DW1000(object):
     def get_rxdata(self):
         rxdata = []
         if self.check_interrupt():
-            status = Reg('SYS_STATUS').read(self.spi)
+            self.snapshot = snap = self.irq_snapshot()
+            if snap:
+                status, finfo, rxbuff = snap['SYS_STATUS'], snap['RX_FINFO'], snap['RX_BUFFER']
+            else:
+                self.spi.begin()
+                status = Reg('SYS_STATUS').read(self.spi)
+                finfo = Reg('RX_FINFO').read(self.spi)
+                self.spi.flush()
+                rxbuff = None
             if status.reg.RXDFR:
-                rxdata = self.rx_data()
+                rxdata = self.rx_data(finfo, rxbuff)
         return rxdata
 
     # Return status string
@@ -513,16 +910,27 @@ class DW1000(object):
 
     # Pulse hardware IRQ pin
     def pulse_irq(self):
-        mode = Reg('GPIO_MODE').read(self.spi).set('MSGP8', 1).write(self.spi)
-        dirn = Reg('GPIO_DIR').read(self.spi).set('GDP8', 0).set('GDM8', 1).write(self.spi)
-        dout = Reg('GPIO_DOUT').read(self.spi).set('GOP8', 1).set('GOM8', 1).write(self.spi)
+        self.spi.begin()
+        mode = self.shadow_reg('GPIO_MODE').set('MSGP8', 1).write(self.spi)
+        dirn = self.shadow_reg('GPIO_DIR').set('GDP8', 0).set('GDM8', 1).write(self.spi)
+        dout = self.shadow_reg('GPIO_DOUT').set('GOP8', 1).set('GOM8', 1).write(self.spi)
+        self.spi.flush()
         msdelay(10)
+        self.spi.begin()
         dout.set('GOP8', 0).write(self.spi)
         mode.set('MSGP8', 0).write(self.spi)
+        self.spi.flush()
 
     # Clear events in interrupt register
+    # If status was pushed by server with IRQ, no need to read it
+    # If batching, any queued transfers are sent before the read
     def clear_irq(self):
-        Reg('SYS_STATUS').read(self.spi).write(self.spi)
+        if self.snapshot:
+            self.snapshot['SYS_STATUS'].write(self.spi)
+        else:
+            r = Reg('SYS_STATUS').read(self.spi)
+            self.spi.sync()
+            r.write(self.spi)
 
     # Check for IRQ from network
     def check_irq(self):
@@ -533,6 +941,8 @@ class DW1000(object):
     # Clear interrupt flag
     def clear_interrupt(self):
         self.spi.interrupt = False
+        self.spi.irq_data = []
+        self.snapshot = None
 
     # Test IRQ pin operation
     def test_irq(self):
@@ -546,23 +956,52 @@ class DW1000(object):
         interrupt = self.check_irq()
         if not interrupt:
             print("Missed interrupt")
+            self.spi.stats.missed_irqs += 1
             interrupt = Reg('SYS_STATUS').read(self.spi).reg.IRQS
         return interrupt
 
     # Get data from Rx buffer, excluding CRC
-    def rx_data(self):
-        nbytes = Reg('RX_FINFO').read(self.spi).reg.RXFLEN
+    # Frame info register is read, unless it has already been fetched
+    # Buffer data is read, unless enough has been pushed with the IRQ
+    def rx_data(self, finfo=None, rxbuff=None):
+        finfo = Reg('RX_FINFO').read(self.spi) if finfo is None else finfo
+        nbytes = finfo.reg.RXFLEN
         if not LONG_FRAMES:
               nbytes &= 0x7f
+        if rxbuff is not None and 2 < nbytes <= len(rxbuff):
+            return memoryview(rxbuff)[:nbytes-2]
         if nbytes > 2:
             hdr = [RX_BUFFER[0]]
             data = nbytes * [0]
             resp = self.spi.xfer(hdr + data)
-            return tuple(resp[1:-2])
+            return memoryview(resp)[1:-2] if resp else []
         return []
 
+    # Read an area of register memory (e.g. ACC_MEM) in fragments, using
+    # sub-address offsets; return bytearray, or None if failed
+    def read_mem(self, id, nbytes, offset=0, skip=0):
+        return self.spi.read_bulk(lambda sub: addr_hdr(id, sub), nbytes, offset, skip)
+
+    # Write an area of register memory (e.g. TX_BUFFER) in fragments
+    def write_mem(self, id, data, offset=0):
+        return self.spi.write_bulk(lambda sub: addr_hdr(id, sub, True), data, offset)
+
+    # Read accumulator (channel impulse response) samples, starting at
+    # the given index; return array of complex values, or None if failed
+    # The accumulator clocks are enabled for the read
+    def read_accum(self, start=0, count=None):
+        count = ACC_MEM[1]//ACC_SAMPLE.size - start if count is None else count
+        r = self.shadow_reg('PMSC_CTRL0')
+        r.set('RXCLKS', 2).set('FACE', 1).set('AMCE', 1).write(self.spi)
+        data = self.read_mem(ACC_MEM[0], count*ACC_SAMPLE.size,
+                             start*ACC_SAMPLE.size, ACC_SKIP)
+        r.set('RXCLKS', 0).set('FACE', 0).set('AMCE', 0).write(self.spi)
+        return None if data is None else accum_array(data)
+
     # Get Rx timestamp
     def rx_time(self):
+        if self.snapshot:
+            return self.snapshot['RX_TIME1'].reg.RX_STAMP
         return Reg('RX_TIME1').read(self.spi).reg.RX_STAMP
 
     # Cancel Tx or Rx, return to idle state
@@ -576,22 +1015,26 @@ class DW1000(object):
     # Read 4 to 8-byte value from OTP memory
     def read_otp(self, addr, nbytes=4):
         self.set_clock("xti")
+        self.spi.begin()
         Reg('OTP_ADDR').set('OTP_ADDR', addr).write(self.spi)
         r = Reg('OTP_CTRL').set('OTPRDEN', 1).set('OTPREAD', 1).write(self.spi)
         r.set('OTPREAD', 0).write(self.spi)
-        val = Reg('OTP_RDAT').read(self.spi).value
+        lo = Reg('OTP_RDAT').read(self.spi)
+        hi = None
         if nbytes > 4:
             Reg('OTP_ADDR').set('OTP_ADDR', addr+4).write(self.spi)
             r.set('OTPREAD', 1).write(self.spi)
             r.set('OTPREAD', 0).write(self.spi)
-            val |= Reg('OTP_RDAT').read(self.spi, nbytes-4).value << 32
+            hi = Reg('OTP_RDAT').read(self.spi, nbytes-4)
         r.set('OTPRDEN', 0).write(self.spi)
+        self.spi.flush()
+        val = lo.value if hi is None else lo.value | (hi.value << 32)
         self.set_clock("auto")
         return val
 
     # Set the system clocks
     def set_clock(self, clk="auto"):
-        r = Reg('PMSC_CTRL0').read(self.spi)
+        r = self.shadow_reg('PMSC_CTRL0')
         if clk == "auto":
             r.set('SYSCLKS', 0).set('RXCLKS', 0).set('TXCLKS', 0)
         elif clk == "xti":
@@ -601,6 +1044,20 @@ class DW1000(object):
         r.write(self.spi)
         msdelay(5)
 
+# Get Tx and Rx timestamps from several units, with the reads overlapped
+def txrx_times_all(dws):
+    posted = [dw.post_txrx_times() for dw in dws]
+    for dw, (tx, rx, reqs) in zip(dws, posted):
+        dw.spi.wait_all(reqs)
+    return [(tx.reg.TX_STAMP, rx.reg.RX_STAMP) for tx, rx, reqs in posted]
+
+# Return accumulator data as a NumPy complex array
+# Without NumPy, return a list of complex values
+def accum_array(data):
+    if np is None:
+        return [complex(re, im) for re, im in ACC_SAMPLE.iter_unpack(data)]
+    return np.frombuffer(data, dtype='<i2').astype(np.float32).view(np.complex64)
+
 # Millisecond time delay
 def msdelay(msec):
     time.sleep(msec / 1000.0)
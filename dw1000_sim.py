@@ -0,0 +1,421 @@
+# Simulated DW1000 units and SPI server, for testing without hardware
+# Copyright (c) Jeremy P Bentham 2019. See iosoft.blog for details
+#
+# Each unit has a UDP port that uses the same protocol as spi_server.py,
+# with a virtual DW1000 register file behind it. Frames are passed between
+# units with timestamps for the given positions and clock drift; network
+# latency and packet loss can be added.
+
+import sys, time, random, threading, asyncio, collections
+from dw1000_regs import Reg, REGDEFS, TX_BUFFER, RX_BUFFER, ACC_MEM
+from dw1000_spi import RESET_VAL, ANS_VAL, IRQ_VAL, SEQLEN
+from dw1000_spi import MACRO_DEF, MACRO_RUN, MACRO_PARAM, MACRO_IRQ
+from dw1000_spi import blocks, block_len
+from dw1000_twr import LIGHT_SPEED, TSTAMP_SEC, TSTAMP_MOD
+
+VERSION     = "0.01"
+SIM_PORT    = 1401          # Port number for first unit
+DEV_ID_VAL  = 0xDECA0130    # Device ID returned by simulated unit
+PMSC_CTRL0_VAL = 0xF0300200 # Power-on value of clock control register
+BUFF_LEN    = 1024          # Size of Tx and Rx buffers
+REPLY_CACHE = 16            # Number of replies kept for retransmitted requests
+RECENT_FRAMES = 64          # Number of transmissions kept for collision check
+TSTAMP_MASK = TSTAMP_MOD - 1 # DW1000 timestamps are 40 bits
+HALF_PERIOD = TSTAMP_MOD // 2
+TX_STATUS   = ('TXFRB', 'TXPRS', 'TXPHS', 'TXFRS')
+RX_STATUS   = ('RXPRD', 'RXSFDD', 'LDEDONE', 'RXPHD', 'RXDFR', 'RXFCG')
+
+verbose     = False
+
+# Return size of storage for each register ID, from register definitions
+def reg_sizes():
+    sizes = {TX_BUFFER[0]:BUFF_LEN, RX_BUFFER[0]:BUFF_LEN, ACC_MEM[0]:ACC_MEM[1]}
+    for rdef in REGDEFS.values():
+        size = (rdef.sub or 0) + rdef.len
+        sizes[rdef.id] = max(sizes.get(rdef.id, 0), size)
+    return sizes
+
+REG_SIZES = reg_sizes()
+
+# Return global time in DW1000 timestamp units
+def global_ticks():
+    return int(time.perf_counter() / TSTAMP_SEC)
+
+# Simulated RF medium, which passes frames between units
+# If a frame duration is given, transmissions in the same RF zone that
+# overlap in time are counted as collisions
+class Air(object):
+    def __init__(self, loss=0.0, frame_time=0.0):
+        self.units, self.loss = [], loss
+        self.frame_ticks = int(frame_time / TSTAMP_SEC)
+        self.recent = {}    # Recent transmission times in each zone
+        self.frames = self.collisions = 0
+
+    # Add a unit
+    def add(self, unit):
+        self.units.append(unit)
+
+    # Count collision if a frame overlaps a recent one in the same zone
+    def check_collision(self, zone, gtime):
+        times = self.recent.setdefault(zone, collections.deque(maxlen=RECENT_FRAMES))
+        if any([abs(gtime - t) < self.frame_ticks for t in times]):
+            self.collisions += 1
+        times.append(gtime)
+
+    # Send a frame from a unit to others in the same RF zone, at given global time
+    def transmit(self, src, gtime, data):
+        self.frames += 1
+        if self.frame_ticks:
+            self.check_collision(src.zone, gtime)
+        for unit in self.units:
+            if (unit is not src and unit.rx_on and unit.zone == src.zone and
+                random.random() >= self.loss):
+                dist = sum([(a-b)**2 for a, b in zip(src.pos, unit.pos)]) ** 0.5
+                tof = int(round(dist / LIGHT_SPEED / TSTAMP_SEC))
+                unit.receive(gtime + tof, data)
+
+# Simulated DW1000 chip
+class SimDW1000(object):
+    def __init__(self, air, pos=(0.0, 0.0, 0.0), ppm=0.0, zone=0):
+        self.air, self.pos, self.zone = air, pos, zone
+        self.ppb = int(ppm * 1000)
+        self.offset = random.getrandbits(40)
+        self.irq_callback = None
+        self.reset()
+        air.add(self)
+
+    # Reset register values
+    def reset(self):
+        self.regs = {id: bytearray(size) for id, size in REG_SIZES.items()}
+        self.set_reg('DEV_ID', DEV_ID_VAL)
+        self.set_reg('PMSC_CTRL0', PMSC_CTRL0_VAL)
+        self.rx_on = self.irq_line = False
+
+    # Get register value
+    def get_reg(self, name):
+        rdef = REGDEFS[name]
+        sub = rdef.sub or 0
+        return Reg(name, int.from_bytes(self.regs[rdef.id][sub:sub+rdef.len], 'little'))
+
+    # Set register value
+    def set_reg(self, name, val):
+        rdef = REGDEFS[name]
+        sub = rdef.sub or 0
+        self.regs[rdef.id][sub:sub+rdef.len] = (val & ((1 << rdef.len*8)-1)).to_bytes(rdef.len, 'little')
+
+    # Set bits in status register
+    def set_status(self, fields):
+        status = self.get_reg('SYS_STATUS')
+        for field in fields:
+            status.set(field, 1)
+        self.set_reg('SYS_STATUS', status.value)
+
+    # Return device clock for given global time (default current time)
+    def clock(self, gtime=None):
+        gtime = global_ticks() if gtime is None else gtime
+        return (gtime + gtime*self.ppb//1000000000 + self.offset) & TSTAMP_MASK
+
+    # Return global time for given device clock value (close to current time)
+    def gtime(self, clk):
+        now = global_ticks()
+        delta = (clk - self.clock(now)) & TSTAMP_MASK
+        if delta >= HALF_PERIOD:
+            delta -= TSTAMP_MOD
+        return now + delta*1000000000//(1000000000+self.ppb)
+
+    # Do an SPI transfer, return response
+    def xfer(self, data):
+        write, id = data[0] & 0x80, data[0] & 0x3f
+        hlen, sub = 1, 0
+        if data[0] & 0x40 and len(data) > 1:
+            hlen, sub = 2, data[1] & 0x7f
+            if data[1] & 0x80 and len(data) > 2:
+                hlen, sub = 3, sub + (data[2] << 7)
+        buff = self.regs.get(id, bytearray())
+        n = len(data) - hlen
+        if len(buff) < sub + n:
+            buff.extend(bytearray(sub + n - len(buff)))
+        if write:
+            if id == REGDEFS['SYS_STATUS'].id:
+                for i, b in enumerate(data[hlen:]):
+                    buff[sub+i] &= ~b
+            else:
+                buff[sub:sub+n] = data[hlen:]
+            self.written(id, sub)
+            resp = list(data)
+        else:
+            if id == REGDEFS['SYS_TIME'].id:
+                self.set_reg('SYS_TIME', self.clock() & ~0x1ff)
+            if id == ACC_MEM[0] and n:
+                # Accumulator reads start with a dummy byte
+                resp = list(data[:hlen]) + [0] + list(buff[sub:sub+n-1])
+            else:
+                resp = list(data[:hlen]) + list(buff[sub:sub+n])
+        self.update_irq()
+        return resp
+
+    # Handle side-effects of a register write
+    def written(self, id, sub):
+        if id == REGDEFS['SYS_CTRL'].id:
+            ctrl = self.get_reg('SYS_CTRL').reg
+            if ctrl.TRXOFF:
+                self.rx_on = False
+            if ctrl.TXSTRT:
+                self.transmit(ctrl.TXDLYS)
+                if ctrl.WAIT4RESP:
+                    self.rx_on = True
+            if ctrl.RXENAB:
+                self.rx_on = True
+            self.set_reg('SYS_CTRL', 0)
+        elif id == REGDEFS['PMSC_CTRL0'].id and sub == 0:
+            if self.get_reg('PMSC_CTRL0').reg.SOFTRESET == 0:
+                self.reset()
+        elif id == REGDEFS['EVC_CTRL'].id and sub == 0:
+            if self.get_reg('EVC_CTRL').reg.EVC_CLR:
+                self.regs[id][4:] = bytearray(len(self.regs[id]) - 4)
+
+    # Transmit frame, optionally delayed until DX_TIME
+    # If the delayed time has passed, the real chip would wait for the
+    # timer to wrap round, so set the warning flag and don't transmit
+    # The Tx timestamp includes the antenna delay
+    def transmit(self, delayed=False):
+        nbytes = self.get_reg('TX_FCTRL').reg.TFLEN
+        data = bytes(self.regs[TX_BUFFER[0]][:max(nbytes-2, 0)])
+        if delayed:
+            clk = self.get_reg('DX_TIME').value & ~0x1ff
+            gtime = self.gtime(clk)
+            if gtime < global_ticks():
+                self.set_status(('HPDWARN',))
+                return
+        else:
+            gtime = global_ticks()
+            clk = self.clock(gtime)
+        self.set_reg('TX_TIME1', clk + self.get_reg('TX_ANTD').value)
+        self.set_status(TX_STATUS)
+        self.count_event('EVC_TXFS')
+        self.air.transmit(self, gtime, data)
+
+    # Receive frame, at given global time
+    def receive(self, gtime, data):
+        nbytes = len(data) + 2
+        self.regs[RX_BUFFER[0]][:nbytes] = data + bytes(2)
+        self.set_reg('RX_FINFO', self.get_reg('RX_FINFO').set('RXFLEN', nbytes).value)
+        self.set_reg('RX_TIME1', self.clock(gtime))
+        self.set_status(RX_STATUS)
+        self.count_event('EVC_FCG')
+        self.rx_on = False
+        self.update_irq()
+
+    # Increment 12-bit event counter, if enabled
+    def count_event(self, name):
+        if self.get_reg('EVC_CTRL').reg.EVC_EN:
+            self.set_reg(name, (self.get_reg(name).value + 1) & 0xfff)
+
+    # Update IRQ line from status & mask registers, or GPIO8 output
+    # Call the IRQ handler on a rising edge
+    def update_irq(self):
+        status = self.get_reg('SYS_STATUS')
+        events = status.value & self.get_reg('SYS_MASK').value & 0xfffffffe
+        if status.reg.IRQS != bool(events):
+            self.set_reg('SYS_STATUS', status.set('IRQS', bool(events)).value)
+        mode, dirn = self.get_reg('GPIO_MODE').reg, self.get_reg('GPIO_DIR').reg
+        gpio8 = mode.MSGP8==1 and dirn.GDP8==0 and self.get_reg('GPIO_DOUT').reg.GOP8
+        level, edge = bool(events) or bool(gpio8), not self.irq_line
+        self.irq_line = level
+        if level and edge and self.irq_callback:
+            self.irq_callback()
+
+# Simulated SPI server for one unit
+class SimServer(asyncio.DatagramProtocol):
+    def __init__(self, dev, latency=0.0, loss=0.0):
+        self.dev, self.latency, self.loss = dev, latency, loss
+        self.transport = self.addr = None
+        self.replies = {}
+        self.macros, self.irq_macro = {}, 0
+        self.loop = asyncio.get_running_loop()
+        dev.irq_callback = self.irq
+
+    # Save transport when connection is made
+    def connection_made(self, transport):
+        self.transport = transport
+
+    # Handle incoming request
+    def datagram_received(self, data, addr):
+        if random.random() < self.loss:
+            return
+        rxdata = bytearray(data)
+        if len(rxdata) <= SEQLEN:
+            return
+        if verbose:
+            print("Rx: %s" % hexvals(rxdata))
+        if addr != self.addr:
+            self.addr = addr
+            self.replies.clear()
+        if rxdata[0] in self.replies:
+            self.xmit(self.replies[rxdata[0]])
+            return
+        txdata = [rxdata[0]]
+        for block in blocks(rxdata[SEQLEN-1:]):
+            if len(block) > 1 and block[0] == MACRO_RUN:
+                resps = self.run_macro(block)
+            else:
+                resps = [self.do_block(block)]
+            for resp in resps:
+                if resp:
+                    txdata += block_len(len(resp)) + list(resp)
+        if len(txdata) > 1:
+            self.replies[txdata[0]] = txdata
+            if len(self.replies) > REPLY_CACHE:
+                del self.replies[next(iter(self.replies))]
+            self.xmit(txdata)
+
+    # Handle a single command block, return response
+    def do_block(self, data):
+        resp = []
+        if len(data) == 1:
+            if data[0] == RESET_VAL:
+                self.dev.reset()
+            resp = [data[0]]
+        elif data[0] == MACRO_DEF:
+            self.macros[data[1]] = [bytearray(d) for d in blocks(data[2:])]
+            resp = [MACRO_DEF, data[1]]
+        elif data[0] == MACRO_IRQ:
+            self.irq_macro = data[1]
+            resp = [MACRO_IRQ, data[1]]
+        elif len(data) > 1:
+            resp = self.dev.xfer(data)
+            if data[0] & 0x80 == 0:
+                resp[0] = ANS_VAL
+        return resp
+
+    # Run a stored sequence, substituting parameters, return list of responses
+    def run_macro(self, data):
+        seq = self.macros.get(data[1], [])
+        params = list(blocks(data[2:]))
+        resps = [[MACRO_RUN, len(seq)]]
+        for block in seq:
+            if block[0] == MACRO_PARAM:
+                param = params[block[1]] if block[1] < len(params) else bytearray()
+                block = block[2:] + param
+            resps.append(self.do_block(block))
+        return resps
+
+    # IRQ from simulated chip: send message, with readout data if required
+    def irq(self):
+        txd = [0, 1, IRQ_VAL]
+        if self.irq_macro:
+            for resp in self.run_macro([MACRO_RUN, self.irq_macro])[1:]:
+                txd += block_len(len(resp)) + list(resp)
+        self.xmit(txd)
+
+    # Transmit data after simulated latency, with simulated loss
+    def xmit(self, txdata):
+        if self.addr and self.transport and random.random() >= self.loss:
+            if verbose:
+                print("Tx: %s" % hexvals(txdata))
+            if self.latency:
+                self.loop.call_later(self.latency, self.transport.sendto,
+                                     bytearray(txdata), self.addr)
+            else:
+                self.transport.sendto(bytearray(txdata), self.addr)
+
+# Simulator for a number of units, each with its own UDP port
+class Simulator(object):
+    def __init__(self, nunits=2, port=SIM_PORT, host="127.0.0.1", distance=1.0,
+                 ppms=None, latency=0.0, loss=0.0, rf_loss=0.0, positions=None,
+                 zones=None, frame_time=0.0):
+        self.host, self.port = host, port
+        self.positions = positions or [(n*distance, 0.0, 0.0) for n in range(nunits)]
+        self.ppms = ppms or [0.0] * len(self.positions)
+        self.zones = zones or [0] * len(self.positions)
+        self.latency, self.loss = latency, loss
+        self.air = Air(rf_loss, frame_time)
+        self.units, self.servers, self.transports = [], [], []
+        self.loop = self.thread = None
+
+    # Return list of SPI interface definitions for the units
+    def spifs(self):
+        return [("UDP", self.host, self.port+n) for n in range(len(self.positions))]
+
+    # Create units and servers in the current event loop
+    async def open(self):
+        self.loop = asyncio.get_running_loop()
+        for n, pos in enumerate(self.positions):
+            dev = SimDW1000(self.air, pos, self.ppms[n], self.zones[n])
+            transport, server = await self.loop.create_datagram_endpoint(
+                lambda: SimServer(dev, self.latency, self.loss),
+                local_addr=(self.host, self.port+n))
+            self.units.append(dev)
+            self.servers.append(server)
+            self.transports.append(transport)
+
+    # Start simulator in a background thread
+    def start(self):
+        ready = threading.Event()
+        errors = []
+        def run():
+            loop = asyncio.new_event_loop()
+            try:
+                loop.run_until_complete(self.open())
+            except OSError as e:
+                errors.append(e)
+            ready.set()
+            if not errors:
+                loop.run_forever()
+            for transport in self.transports:
+                transport.close()
+            loop.run_until_complete(asyncio.sleep(0))
+            loop.close()
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+        ready.wait()
+        if errors:
+            self.thread.join()
+            raise errors[0]
+        return self
+
+    # Stop simulator, closing sockets
+    def stop(self):
+        if self.loop:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+        if self.thread:
+            self.thread.join()
+        self.loop = self.thread = None
+        self.transports = []
+
+# Return string with hex values of bytes
+def hexvals(data):
+    return " ".join(["%02X" % b for b in bytearray(data)])
+
+if __name__ == "__main__":
+    nunits, port, dist, latency, loss = 2, SIM_PORT, 1.0, 0.0, 0.0
+    args = iter(sys.argv[1:])
+    for arg in args:
+        if arg.lower() == "-v":
+            verbose = True
+        elif arg == "-n":
+            nunits = int(next(args))
+        elif arg == "-d":
+            dist = float(next(args))
+        elif arg == "-l":
+            latency = float(next(args)) / 1000.0
+        elif arg == "-p":
+            loss = float(next(args))
+        elif arg[0].isdigit():
+            port = int(arg)
+        else:
+            print("Unrecognised argument '%s'" % arg)
+            print("Usage: dw1000_sim.py [-v] [-n units] [-d metres] [-l msec] [-p loss] [port]")
+            sys.exit(1)
+    print("DW1000_SIM v" + VERSION)
+    sim = Simulator(nunits, port, "0.0.0.0", dist, latency=latency, loss=loss)
+    for spif in sim.spifs():
+        print("Unit on UDP port %u" % spif[2])
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(sim.open())
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+
+# EOF
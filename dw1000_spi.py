@@ -12,7 +12,7 @@
 # RESET 22 (BCM25)  37 (BCM26)
 # IRQ   18          32
 
-import sys, socket, time, select, dw1000_regs as regs
+import sys, socket, time, select, struct, dw1000_regs as regs
 from dw1000_regs import Reg, msdelay
 
 RESET_VAL       = 0xff
@@ -20,56 +20,365 @@ ANS_VAL         = 0xaa
 SOCK_TIMEOUT    = 0.05
 MAX_DATALEN     = 2048
 IRQ_VAL         = 0xfe
+MACRO_DEF       = 0xfd
+MACRO_RUN       = 0xfc
+MACRO_PARAM     = 0xfb
+MACRO_IRQ       = 0xfa
+WIDE_BLOCK      = 0xff  # Block length byte, followed by 2-byte length
+FRAG_LEN        = 1016  # Max data bytes in each fragment of a bulk transfer
 SEQLEN          = 2
+FRAME_HDR       = struct.Struct('<H')   # Length prefix for stream transports
+PORTNUM         = 1401
 RETRIES         = 3
+RTO_MIN         = 0.005 # Min & max retransmit timeout (sec)
+RTO_MAX         = 0.5
+RTT_ALPHA       = 0.125 # Gain for smoothed RTT
+RTT_BETA        = 0.25  # Gain for RTT variation
+IRQ_TIMEOUT     = 0.05  # Default time to wait for IRQ (sec)
+WINDOW          = 8     # Max number of outstanding requests
+RTT_BUCKETS     = 24    # Latency histogram buckets, powers of 2 usec
+STATS_INTERVAL  = 0     # Interval for printing statistics (sec), 0 to disable
 
 resetime        = time.time()
 
+# Counters & round-trip latency histogram for an SPI interface
+# Bucket n holds times of 2**(n-1) to 2**n usec; the last is open-ended
+class SpiStats(object):
+    COUNTERS = ('xfers', 'retries', 'timeouts', 'stale', 'irqs', 'missed_irqs')
+
+    def __init__(self, ident='1', interval=STATS_INTERVAL):
+        self.ident, self.interval = ident, interval
+        self.clear()
+
+    # Reset all values
+    def clear(self):
+        self.xfers = self.retries = self.timeouts = self.stale = 0
+        self.irqs = self.missed_irqs = 0
+        self.rtt_total = 0.0
+        self.rtt_min = self.rtt_max = None
+        self.hist = RTT_BUCKETS * [0]
+        self.dumptime = time.perf_counter()
+
+    # Add the round-trip time of a successful transfer, in seconds
+    def add_rtt(self, rtt):
+        self.xfers += 1
+        self.rtt_total += rtt
+        if self.rtt_min is None or rtt < self.rtt_min:
+            self.rtt_min = rtt
+        if self.rtt_max is None or rtt > self.rtt_max:
+            self.rtt_max = rtt
+        self.hist[min(int(rtt * 1e6).bit_length(), RTT_BUCKETS-1)] += 1
+        if self.interval and time.perf_counter()-self.dumptime >= self.interval:
+            self.dump()
+
+    # Return approximate RTT percentile in seconds, from histogram
+    def rtt_percentile(self, pc):
+        target, total = self.xfers * pc / 100.0, 0
+        for n, count in enumerate(self.hist):
+            total += count
+            if count and total >= target:
+                return min((1 << n) / 1e6, self.rtt_max)
+        return 0.0
+
+    # Return dictionary with a snapshot of the values
+    def snapshot(self):
+        snap = {name: getattr(self, name) for name in self.COUNTERS}
+        snap['rtt_mean'] = self.rtt_total / self.xfers if self.xfers else 0.0
+        snap['rtt_min'] = self.rtt_min or 0.0
+        snap['rtt_max'] = self.rtt_max or 0.0
+        snap['rtt_p50'] = self.rtt_percentile(50)
+        snap['rtt_p99'] = self.rtt_percentile(99)
+        snap['rtt_hist'] = list(self.hist)
+        return snap
+
+    # Print statistics to stderr
+    def dump(self):
+        self.dumptime = time.perf_counter()
+        sys.stderr.write(str(self) + "\n")
+        sys.stderr.flush()
+
+    # Return string with statistics
+    def __str__(self):
+        snap = self.snapshot()
+        s = "%s " % self.ident + " ".join(["%s:%u" % (name, snap[name])
+                                            for name in self.COUNTERS])
+        return s + " rtt mean:%1.3f p50:%1.3f p99:%1.3f max:%1.3f ms" % tuple(
+            [snap[k]*1e3 for k in ('rtt_mean', 'rtt_p50', 'rtt_p99', 'rtt_max')])
+
+# Request datagram sent to SPI server, with response when complete
+# Response is empty if there was no reply after retries
+class Request(object):
+    def __init__(self, txdata, nresps, callbacks=None, posted=False):
+        self.seq, self.txdata, self.nresps = txdata[0], txdata, nresps
+        self.callbacks, self.posted = callbacks, posted
+        self.rxdata = None
+        self.start = time.perf_counter()
+        self.retries = 0
+
+    # Return True if request is complete
+    def done(self):
+        return self.rxdata is not None
+
 # Class for an SPI interface
 class Spi(object):
     def __init__(self, spif, ident='1'):
         self.spif, self.ident = spif, ident
         self.txseq = 0
+        self.queue, self.depth = None, 0
+        self.shadow = {}    # Register values, keyed by (id, sub-address)
+        self.macros = {}    # Blocks in each stored sequence, keyed by number
         self.verbose = self.interrupt = False
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        if self.sock:
-            self.sock.connect(spif[1:])
-            print("Connected to %s:%u" % spif[1:])
-        else:
-            print("Can't open socket")
-    
+        self.irq_data = []  # Readout data pushed by server with IRQ
+        self.pending = {}   # Outstanding requests, keyed by sequence number
+        self.window = WINDOW
+        self.stats = SpiStats(ident)
+        self.irq_timeout = IRQ_TIMEOUT
+        self.reset_rtt()
+        self.stream = spif[0] != "UDP"
+        self.buff = bytearray()
+        self.sock = None
+        self.connect()
+
+    # Open socket to SPI server
+    def connect(self):
+        self.sock = open_socket(self.spif)
+        print("Connected to %s" % spif_str(self.spif))
+
     # Do an SPI transfer over the network, return response
-    def xfer(self, txdata):
-        resp = []
-        txdata = [self.txseq, len(txdata)] + txdata
+    # If batching, queue the transfer, and pass response to callback on flush
+    def xfer(self, txdata, callback=None):
+        if regs.trace:
+            regs.trace_write(txdata)
+        if self.queue is not None:
+            self.queue.append((txdata, callback))
+            return []
+        resp = read_resp(self.transact([txdata])[0])
+        if callback:
+            callback(resp)
+        return resp
+
+    # Start queueing transfers, to be sent as one datagram
+    # Batches may be nested; transfers are sent by the outermost flush
+    def begin(self):
+        if self.queue is None:
+            self.queue = []
+        self.depth += 1
+
+    # End a batch, sending queued transfers if it is the outermost
+    def flush(self):
+        self.depth = max(self.depth-1, 0)
+        if self.depth == 0:
+            self.sync()
+            self.queue = None
+
+    # Send queued transfers, but remain in batch mode
+    # Splits into datagrams if too large
+    def sync(self):
+        if not self.queue:
+            return
+        queue, self.queue = self.queue, []
+        for chunk in queue_chunks(queue):
+            self.flush_chunk(chunk)
+
+    # Send a list of queued transfers, pass responses to callbacks
+    def flush_chunk(self, chunk):
+        self.wait(self.submit_chunk(chunk))
+
+    # Send a list of queued transfers without waiting, return request
+    def submit_chunk(self, chunk, posted=False):
+        return self.submit([txdata for txdata, callback in chunk],
+                           callbacks=[callback for txdata, callback in chunk],
+                           posted=posted)
+
+    # End batch, sending queued transfers without waiting for responses
+    # Returns list of requests; wait_all() passes responses to callbacks
+    # Requests may be executed out of order if one is lost, so only
+    # independent transfers (e.g. reads) should be posted
+    # If in an outer batch, the transfers are sent by its flush, and no
+    # requests are returned
+    def post(self):
+        self.depth = max(self.depth-1, 0)
+        if self.depth:
+            return []
+        queue, self.queue = self.queue or [], None
+        return [self.submit_chunk(chunk, True) for chunk in queue_chunks(queue)]
+
+    # Wait for a list of requests, return list of responses for each
+    def wait_all(self, reqs):
+        return [self.wait(req) for req in reqs]
+
+    # Store a sequence of SPI blocks on the server, as a numbered macro
+    # A block may be a tuple (param_index, header), in which case the data
+    # is taken from the parameters when the macro is run
+    def define(self, num, blocks):
+        data = [MACRO_DEF, num]
+        for block in blocks:
+            if isinstance(block, tuple):
+                block = [MACRO_PARAM, block[0]] + list(block[1])
+            data += block_len(len(block)) + list(block)
+        resp = self.transact([data])[0]
+        ok = list(resp) == [MACRO_DEF, num]
+        if ok:
+            self.macros[num] = list(blocks)
+        return ok
+
+    # Run a stored macro with optional parameters, return list of raw
+    # responses for each block (use read_resp to get read data)
+    # Returns None if the server replies that the macro isn't defined; if
+    # there is no reply, the responses are empty, as the macro may have run
+    def run(self, num, params=()):
+        self.sync()
+        data = bytearray([MACRO_RUN, num])
+        for param in params:
+            data.extend(block_len(len(param)))
+            data.extend(param)
+        macro = self.macros.get(num, [])
+        resps = self.transact([data], len(macro)+1)
+        if not resps[0]:
+            return resps[1:]
+        if not macro or list(resps[0]) != [MACRO_RUN, len(macro)]:
+            return None
+        if regs.trace:
+            for block in macro:
+                regs.trace_write(list(block[1]) + list(params[block[0]])
+                                 if isinstance(block, tuple) else block)
+        return resps[1:]
+
+    # Set stored macro to be run by the server when an IRQ occurs
+    # The responses are sent with the IRQ message; 0 to disable
+    def irq_readout(self, num):
+        resp = self.transact([[MACRO_IRQ, num]])[0]
+        return list(resp) == [MACRO_IRQ, num]
+
+    # Read a large area of memory as fragments, using sub-address offsets
+    # 'hdr' is a function returning the SPI header for an offset, 'skip' is
+    # the number of dummy bytes at the start of each read response
+    # Fragments are sent without waiting, up to the window size
+    # Returns bytearray, or None if any fragment failed
+    def read_bulk(self, hdr, nbytes, offset=0, skip=0):
+        self.sync()
+        frags = [(bytearray(hdr(offset+n)), min(FRAG_LEN, nbytes-n))
+                 for n in range(0, nbytes, FRAG_LEN)]
+        queue = [(h + bytearray(size+skip), None) for h, size in frags]
+        reqs = [self.submit_chunk(chunk) for chunk in queue_chunks(queue)]
+        resps = [read_resp(r) for resp in self.wait_all(reqs) for r in resp]
+        data = bytearray()
+        for (h, size), resp in zip(frags, resps):
+            if len(resp) != len(h) + skip + size:
+                return None
+            data += memoryview(resp)[len(h)+skip:]
+        return data
+
+    # Write a large area of memory as fragments, using sub-address offsets
+    # Return True if all fragments were written
+    def write_bulk(self, hdr, data, offset=0):
+        self.sync()
+        data = memoryview(bytes(data))
+        queue = [(bytearray(hdr(offset+n)) + data[n:n+FRAG_LEN], None)
+                 for n in range(0, len(data), FRAG_LEN)]
+        if regs.trace:
+            for txdata, callback in queue:
+                regs.trace_write(txdata)
+        reqs = [self.submit_chunk(chunk) for chunk in queue_chunks(queue)]
+        resps = [r for resp in self.wait_all(reqs) for r in resp]
+        return len(resps) == len(queue) and all(resps)
+
+    # Send one or more SPI blocks in a single datagram, return responses
+    def transact(self, blocks, nresps=None):
+        return self.wait(self.submit(blocks, nresps))
+
+    # Send one or more SPI blocks in a single datagram, return request
+    # If the window is full, wait for the oldest request to complete
+    # A posted request's response may not be read until later, so isn't
+    # used for the RTT estimate
+    def submit(self, blocks, nresps=None, callbacks=None, posted=False):
+        while len(self.pending) >= self.window:
+            self.wait(next(iter(self.pending.values())))
+        txdata = request_data(self.txseq, blocks)
         self.txseq = (self.txseq % 255) + 1
+        req = Request(txdata, len(blocks) if nresps is None else nresps, callbacks, posted)
+        self.pending[req.seq] = req
         self.send(txdata)
-        retries = RETRIES
-        rxdata = []
-        while not rxdata:
-            rxdata = self.receive()
+        return req
+
+    # Wait for request to complete, return responses, and pass them to
+    # the callbacks (if any). Replies to other outstanding requests are
+    # matched by sequence number. The request is resent on timeout,
+    # and the retransmit timeout is doubled after each retry
+    def wait(self, req):
+        while not req.done():
+            rxdata = self.receive(timeout=self.rto)
             if len(rxdata) > SEQLEN:
-                if rxdata[0] != txdata[0]:
-                    rxdata = []
-            elif retries>0:
-                self.send(txdata)
-                retries -= 1
+                self.complete(rxdata)
+            elif req.retries < RETRIES:
+                self.backoff()
+                if not self.stream:
+                    self.send(req.txdata)
+                    self.stats.retries += 1
+                req.retries += 1
             else:
-                break
-        if len(rxdata)>SEQLEN and rxdata[SEQLEN]==ANS_VAL:
-            resp = bytearray(rxdata[SEQLEN:])
-        return resp
+                self.stats.timeouts += 1
+                self.pending.pop(req.seq, None)
+                req.rxdata = []
+        resps = split_blocks(req.rxdata, req.nresps)
+        callbacks, req.callbacks = req.callbacks, None
+        for callback, resp in zip(callbacks or [], resps):
+            if callback:
+                callback(read_resp(resp))
+        return resps
+
+    # Match reply to outstanding request, and update RTT estimate
+    # Posted requests aren't measured, as the reply may have been waiting
+    def complete(self, rxdata):
+        req = self.pending.pop(rxdata[0], None)
+        if req is None:
+            self.stats.stale += 1
+            return
+        req.rxdata = rxdata
+        rtt = time.perf_counter() - req.start
+        self.stats.add_rtt(rtt)
+        if req.retries == 0 and not req.posted:
+            self.update_rtt(rtt)
+
+    # Set initial round-trip time estimate & retransmit timeout
+    def reset_rtt(self):
+        self.srtt, self.rttvar, self.rto = None, 0.0, SOCK_TIMEOUT
+
+    # Update smoothed RTT and variation (as TCP, RFC 6298) with a
+    # measurement, and recalculate retransmit timeout
+    # Retransmitted requests aren't measured, as the reply is ambiguous
+    def update_rtt(self, rtt):
+        if self.srtt is None:
+            self.srtt, self.rttvar = rtt, rtt / 2.0
+        else:
+            self.rttvar += RTT_BETA * (abs(self.srtt - rtt) - self.rttvar)
+            self.srtt += RTT_ALPHA * (rtt - self.srtt)
+        self.rto = min(max(self.srtt + 4*self.rttvar, RTO_MIN), RTO_MAX)
+
+    # Double the retransmit timeout after a loss
+    def backoff(self):
+        self.rto = min(self.rto * 2, RTO_MAX)
 
     # Send outgoing data
+    # If a stream has been closed by the server, the data is discarded, and
+    # the request times out, as for a lost datagram
     def send(self, txdata):
         if self.verbose:
             rw = "Wr:" if txdata[SEQLEN] & 0x80 else "Rd:"
             print("%1.3f %s%s %s" % (logtime(), rw,
                   self.ident, regs.data_str(txdata, SEQLEN)))
-        self.sock.send(bytearray(txdata))
+        if self.stream:
+            try:
+                self.sock.sendall(frame(txdata))
+            except OSError:
+                pass
+        else:
+            self.sock.send(txdata)
 
     # Receive incoming data with timeout
     def recv(self, maxlen=MAX_DATALEN, timeout=SOCK_TIMEOUT):
+        if self.stream:
+            return self.recv_frame(maxlen, timeout)
         data = []
         rd, wr, ex = select.select([self.sock], [], [], timeout)
         for s in rd:
@@ -79,27 +388,52 @@ class Spi(object):
                 data = []
         return data
 
+    # Receive length-prefixed data from stream, with timeout
+    def recv_frame(self, maxlen=MAX_DATALEN, timeout=SOCK_TIMEOUT):
+        deadline = time.perf_counter() + timeout
+        data, self.buff = unframe(self.buff)
+        while data is None and timeout >= 0:
+            rd, wr, ex = select.select([self.sock], [], [], timeout)
+            if not rd:
+                break
+            try:
+                rxd = self.sock.recv(maxlen + FRAME_HDR.size)
+            except OSError:
+                rxd = b''
+            if not rxd:
+                break
+            data, self.buff = unframe(self.buff + rxd)
+            timeout = deadline - time.perf_counter()
+        return data or []
+
     # Receive network response, single byte is an interrupt
     # Save interrupt in a flag, but don't return unless arg is set
-    def receive(self, irq_return=False):
+    # Interrupt may be followed by readout data, which is saved
+    # Default timeout is the IRQ timeout if waiting for an IRQ, otherwise
+    # the retransmit timeout
+    def receive(self, irq_return=False, timeout=None):
+        if timeout is None:
+            timeout = self.irq_timeout if irq_return else self.rto
         loop = True
         resp = []
         while loop:
-            resp = bytearray(self.recv())
+            resp = bytearray(self.recv(timeout=timeout))
             if self.verbose:
                 print("%1.3f    %s %s" % (logtime(), 
                       self.ident, hexvals(resp)))
-            if len(resp)==1+SEQLEN and resp[SEQLEN]==IRQ_VAL:
+            if is_irq(resp):
+                self.stats.irqs += 1
                 self.interrupt = True
+                self.irq_data = irq_readout_data(resp)
                 if irq_return:
                     loop = False
             else:
                 loop = False
         return resp
 
-    # Return timeout value in msec
+    # Return retransmit timeout value in msec
     def get_timeout(self):
-        return int(SOCK_TIMEOUT * 1000)
+        return int(self.rto * 1000)
 
     # Assert or negate hardware reset pin
     def reset(self, on):
@@ -115,6 +449,107 @@ def logtime(reset=False):
     global resetime
     return (time.time() - resetime) % 10.0
 
+# Open socket for SPI interface: ("UDP", host, port), ("TCP", host, port),
+# or ("UNIX", path)
+def open_socket(spif):
+    if spif[0] == "UNIX":
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(spif[1])
+    elif spif[0] == "TCP":
+        sock = socket.create_connection(spif[1:])
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.connect(spif[1:])
+    return sock
+
+# Return SPI interface definition from string: 'unix:<path>',
+# 'tcp:<host>[:<port>]', or '[udp:]<host>[:<port>]'
+def parse_spif(s):
+    mode, _, addr = s.partition(':')
+    if mode.upper() not in ("UDP", "TCP", "UNIX"):
+        mode, addr = "UDP", s
+    if mode.upper() == "UNIX":
+        return "UNIX", addr
+    host, _, port = addr.partition(':')
+    return mode.upper(), host, int(port or PORTNUM)
+
+# Return string describing SPI interface
+def spif_str(spif):
+    return "%s %s" % (spif[0], ":".join([str(s) for s in spif[1:]]))
+
+# Return data with length prefix, for stream transports
+def frame(data):
+    return FRAME_HDR.pack(len(data)) + bytes(data)
+
+# Return first complete length-prefixed frame from buffer (None if not
+# complete), and remaining buffer
+def unframe(buff):
+    if len(buff) >= FRAME_HDR.size:
+        n = FRAME_HDR.unpack_from(buff)[0] + FRAME_HDR.size
+        if len(buff) >= n:
+            return buff[FRAME_HDR.size:n], buff[n:]
+    return None, buff
+
+# Return request datagram: sequence number, then length-prefixed blocks
+# Blocks may be lists, bytearrays or memoryviews
+def request_data(seq, blocks):
+    txdata = bytearray([seq])
+    for block in blocks:
+        txdata.extend(block_len(len(block)))
+        txdata.extend(block)
+    return txdata
+
+# Return length prefix for a block: 1 byte, or if the block is 255 bytes
+# or longer, WIDE_BLOCK then 2-byte little-endian length
+# Shorter blocks (including empty ones) are as understood by old servers
+def block_len(n):
+    return [n] if n < WIDE_BLOCK else [WIDE_BLOCK, n & 0xff, n >> 8]
+
+# Return iterator for length-prefixed blocks
+def blocks(rxd):
+    n = 0
+    while n < len(rxd):
+        size, n = rxd[n], n+1
+        if size == WIDE_BLOCK:
+            if n+2 > len(rxd):
+                break
+            size, n = rxd[n] | (rxd[n+1] << 8), n+2
+        if n+size > len(rxd):
+            break
+        yield rxd[n:n+size]
+        n += size
+
+# Return iterator for lists of queued transfers that fit in a datagram
+def queue_chunks(queue):
+    chunk, size = [], SEQLEN
+    for txdata, callback in queue:
+        n = len(txdata) + len(block_len(len(txdata)))
+        if chunk and size+n > MAX_DATALEN:
+            yield chunk
+            chunk, size = [], SEQLEN
+        chunk.append((txdata, callback))
+        size += n
+    if chunk:
+        yield chunk
+
+# Split response datagram into length-prefixed blocks
+def split_blocks(rxdata, nblocks):
+    resps = [bytearray(block) for block in blocks(rxdata[SEQLEN-1:])]
+    return resps + (nblocks-len(resps))*[[]]
+
+# Return True if datagram is an IRQ message
+def is_irq(resp):
+    return len(resp)>SEQLEN and resp[SEQLEN-1]==1 and resp[SEQLEN]==IRQ_VAL
+
+# Return list of readout responses following IRQ
+def irq_readout_data(resp):
+    return [read_resp(r) for r in split_blocks(resp, 0)[1:]]
+
+# Return response if it is read data (starting with ANS_VAL), else empty
+def read_resp(resp):
+    return resp if len(resp) and resp[0]==ANS_VAL else []
+
 # Return string with hex values of bytes    
 def hexvals(data):
     return " ".join(["%02X" % b for b in bytearray(data)])
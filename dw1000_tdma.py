@@ -0,0 +1,352 @@
+# TDMA scheduling of blink transmissions from many DW1000 tags
+# Copyright (c) Jeremy P Bentham 2019. See iosoft.blog for details
+#
+# Each tag EUI is given a slot in a superframe, and transmits a blink in
+# that slot using delayed Tx, so there are no ALOHA-style collisions, and
+# the aggregate update rate scales with the number of tags. Each tag's
+# SYS_TIME clock is related to host time by reading it over the network;
+# the guard time between slots allows for the uncertainty of that reading.
+# Slots are reallocated at superframe boundaries as tags join or leave;
+# the superframe doubles in size when full, and halves when 1/4 full.
+# Blinks are programmed up to two superframes ahead, so the superframe
+# length is limited to keep that well within the delayed Tx time range.
+
+import sys, heapq, asyncio
+from dw1000_async import start_units
+from dw1000_spi import parse_spif
+from dw1000_regs import DX_TIME_MASK, TSTAMP_MASK, DEF_RATE, DEF_PREAM_LEN, DEF_PULSE_FREQ
+from dw1000_range import Frame, BLINK_MSG, BLINK_FRAME_CTRL
+from dw1000_twr import TSTAMP_SEC, TSTAMP_MOD
+
+SLOT_GUARD   = 0.002    # Guard time between frames in adjacent slots (sec)
+MIN_SLOTS    = 8        # Min & max number of slots in superframe
+MAX_SLOTS    = 4096
+SYNC_INTERVAL= 2.0      # Max time between tag clock readings (sec)
+SYNC_TRIES   = 3        # Clock readings per sync; the fastest is used
+MAX_DRIFT    = 40e-6    # Max clock rate difference between tag & host
+START_LEAD   = 0.05     # Time to program tags before first superframe (sec)
+PROGRAM_LEAD = 0.005    # Min time between programming and Tx (sec)
+TAG_EUI_BASE = 0xDECA000000000000   # EUI of first tag (if not specified)
+
+# Max time a blink is programmed ahead (sec): a quarter of the timestamp
+# period, so well within the half-period range of a delayed Tx time
+MAX_LEAD     = TSTAMP_MOD * TSTAMP_SEC / 4
+
+# Symbol times (nsec) for each PRF, and bit times for each data rate
+SYMBOL_NS    = {16:993.59, 64:1017.63}
+BIT_NS       = {110:8205.13, 850:1025.64, 6800:128.21}
+
+# Return air time of a frame with given data length (excluding CRC)
+def frame_time(nbytes, rate=DEF_RATE, plen=DEF_PREAM_LEN, prf=DEF_PULSE_FREQ):
+    return preamble_time(rate, plen, prf) + data_time(nbytes, rate)
+
+# Return time for preamble & SFD, i.e. from start of Tx to the timestamp
+def preamble_time(rate=DEF_RATE, plen=DEF_PREAM_LEN, prf=DEF_PULSE_FREQ):
+    sfd = 64 if rate == 110 else 8
+    return (plen + sfd) * SYMBOL_NS[prf] * 1e-9
+
+# Return time for PHY header & data (with CRC and Reed-Solomon parity bits)
+def data_time(nbytes, rate=DEF_RATE):
+    bits = (nbytes + 2) * 8
+    bits += 48 * ((bits + 329) // 330)
+    phr = 21 * BIT_NS[110 if rate == 110 else 850]
+    return (phr + bits * BIT_NS[rate]) * 1e-9
+
+# Relation between a tag's clock and host time, from a SYS_TIME reading
+# The error is half the round-trip time of the reading, plus the drift since
+class TagClock(object):
+    def __init__(self):
+        self.host = self.dev = None
+        self.err = float('inf')
+
+    # Set reference point from a reading, if it is better than the current one
+    def update(self, host, dev, rtt, force=False):
+        if force or rtt/2.0 < self.error(host):
+            self.host, self.dev, self.err = host, dev, rtt/2.0
+
+    # Return device time at host time
+    def dev_time(self, t):
+        return (self.dev + int((t - self.host) / TSTAMP_SEC)) & TSTAMP_MASK
+
+    # Return max error of device time at host time
+    def error(self, t):
+        if self.host is None:
+            return float('inf')
+        return self.err + abs(t - self.host) * MAX_DRIFT
+
+# A tag: DW1000 unit with EUI, clock, and blink frame
+class Tag(object):
+    def __init__(self, dw, eui):
+        self.dw, self.eui = dw, eui
+        self.clock = TagClock()
+        self.frame = Frame(BLINK_MSG)
+        self.frame.values.framectrl = BLINK_FRAME_CTRL
+        self.frame.values.tagid = eui
+        self.synced = None      # Host time of last clock sync
+        self.sent = self.late = 0
+
+    # Read clock, keeping the reading with the shortest round-trip time
+    async def sync(self):
+        readings = [await self.dw.sys_time() for n in range(SYNC_TRIES)]
+        host, dev, rtt = min(readings, key=lambda r: r[2])
+        self.clock.update(host, dev, rtt, True)
+        self.synced = host
+
+    # Return True if the clock needs to be read
+    def needs_sync(self, t):
+        return self.synced is None or t - self.synced > SYNC_INTERVAL
+
+    # Start blink transmission at host time; the time is that of the
+    # timestamp, so the preamble starts earlier. Return True if started
+    async def blink_at(self, t):
+        ok = await self.dw.transmit_at(self.clock.dev_time(t) & DX_TIME_MASK,
+                                       self.frame.data())
+        if ok:
+            self.sent += 1
+        else:
+            self.late += 1
+        return ok
+
+# Allocation of tag EUIs to slots in a superframe
+# Free slots are kept in a heap, so the lowest is allocated first
+class SlotTable(object):
+    def __init__(self, nslots=MIN_SLOTS, min_slots=MIN_SLOTS, max_slots=MAX_SLOTS):
+        self.min_slots, self.max_slots = min_slots, max_slots
+        self.slots = {}     # Slot for each EUI
+        self.resize(nslots)
+
+    # Return number of tags with slots
+    def __len__(self):
+        return len(self.slots)
+
+    # Return fraction of slots in use
+    def occupancy(self):
+        return len(self.slots) / float(self.nslots)
+
+    # Allocate slot to a tag, return slot number or None if full
+    def assign(self, eui):
+        if eui not in self.slots and self.free:
+            self.slots[eui] = heapq.heappop(self.free)
+        return self.slots.get(eui)
+
+    # Free the slot of a tag
+    def remove(self, eui):
+        slot = self.slots.pop(eui, None)
+        if slot is not None:
+            heapq.heappush(self.free, slot)
+
+    # Change number of slots; tags keep their slots if possible, others are
+    # moved to the lowest free slots. Return number of tags moved
+    def resize(self, nslots):
+        self.nslots = nslots
+        used = set(self.slots.values())
+        self.free = [n for n in range(nslots) if n not in used]
+        heapq.heapify(self.free)
+        moved = [eui for eui, slot in self.slots.items() if slot >= nslots]
+        for eui in moved:
+            self.slots[eui] = heapq.heappop(self.free)
+        return len(moved)
+
+    # Apply joins & leaves, doubling or halving the number of slots if
+    # required; return number of tags moved. Joins that don't fit in the
+    # max number of slots aren't assigned
+    def rebalance(self, joins=(), leaves=()):
+        for eui in leaves:
+            self.remove(eui)
+        need = len(set(self.slots) | set(joins))
+        n = self.nslots
+        while need > n and n < self.max_slots:
+            n *= 2
+        while n > self.min_slots and need <= n // 4:
+            n //= 2
+        moved = self.resize(n) if n != self.nslots else 0
+        for eui in joins:
+            self.assign(eui)
+        return moved
+
+# Statistics for one superframe
+class SuperframeStats(object):
+    def __init__(self, num, nslots, ntags, duration):
+        self.num, self.nslots, self.ntags, self.duration = num, nslots, ntags, duration
+        self.sent = self.late = self.collisions = self.moved = self.rejected = 0
+
+    # Return string with statistics
+    def __str__(self):
+        return ("SF %u: %u/%u slots (%1.0f%%) sent:%u late:%u collisions:%u moved:%u "
+                "rejected:%u %1.1f blinks/s" % (self.num, self.ntags, self.nslots,
+                100.0*self.ntags/self.nslots, self.sent, self.late, self.collisions,
+                self.moved, self.rejected, self.sent/self.duration))
+
+# Return max number of slots (min slots times a power of 2) so that the
+# next blink of any tag is less than MAX_LEAD ahead, i.e. a superframe is
+# at most half of that
+def slot_limit(slot_time, min_slots=MIN_SLOTS):
+    if 2 * min_slots * slot_time > MAX_LEAD:
+        raise ValueError("Slot time too long")
+    n = min_slots
+    while 2 * (n*2) * slot_time <= MAX_LEAD:
+        n *= 2
+    return n
+
+# Scheduler for tag blinks in superframe slots
+# Each tag is programmed with its next blink just after its slot in the
+# current superframe, so there is almost a superframe of lead time; new
+# tags are programmed up to two superframes ahead. The number of slots is
+# limited by the slot time, so joins that don't fit are rejected
+class TdmaScheduler(object):
+    def __init__(self, slot_time=None, guard=SLOT_GUARD, table=None):
+        self.ftime = frame_time(Frame(BLINK_MSG).layout.size)
+        self.slot_time = slot_time or self.ftime + guard
+        self.guard = self.slot_time - self.ftime
+        self.table = SlotTable() if table is None else table
+        self.table.max_slots = min(self.table.max_slots,
+                                   slot_limit(self.slot_time, self.table.min_slots))
+        self.tags = {}
+        self.joins, self.leaves = {}, set()
+        self.history = []
+        self.rejected = 0   # Number of joins rejected as the table was full
+        self.loop = None
+
+    # Add a tag (at the next superframe boundary)
+    def join(self, dw, eui):
+        self.joins[eui] = Tag(dw, eui)
+        self.leaves.discard(eui)
+
+    # Remove a tag (at the next superframe boundary)
+    def leave(self, eui):
+        self.joins.pop(eui, None)
+        self.leaves.add(eui)
+
+    # Apply joins & leaves to slot table, return number of tags moved, and
+    # number of joins rejected because there were no free slots
+    def rebalance(self):
+        joins, leaves = self.joins, self.leaves
+        self.joins, self.leaves = {}, set()
+        for eui in leaves:
+            self.tags.pop(eui, None)
+        moved = self.table.rebalance(list(joins), leaves)
+        rejected = 0
+        for eui, tag in joins.items():
+            if eui in self.table.slots:
+                self.tags[eui] = tag
+            else:
+                rejected += 1
+        self.rejected += rejected
+        return moved, rejected
+
+    # Return host time of the timestamp of a blink in a slot
+    def slot_tx_time(self, start, slot):
+        return start + slot*self.slot_time + self.guard + preamble_time()
+
+    # Program a tag to blink in a slot; return (time, error, EUI) of the
+    # blink, or None if it is too late to start it
+    async def program(self, tag, start, slot):
+        t = self.slot_tx_time(start, slot)
+        if tag.needs_sync(self.loop.time()):
+            await tag.sync()
+        if t - self.loop.time() < PROGRAM_LEAD:
+            tag.late += 1
+            return None
+        if not await tag.blink_at(t):
+            return None
+        return t, tag.clock.error(t), tag.eui
+
+    # Wait until host time
+    async def sleep_until(self, t):
+        delay = t - self.loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    # Run a number of superframes (forever if None), calling the report
+    # function (if any) with the statistics for each
+    async def run(self, count=None, report=None):
+        self.loop = asyncio.get_running_loop()
+        moved, rejected = self.rebalance()
+        start = self.loop.time() + START_LEAD
+        plan = dict(self.table.slots)
+        blinks = await asyncio.gather(*[self.program(self.tags[eui], start, slot)
+                                        for eui, slot in plan.items()])
+        stats = self.superframe_stats(0, start, plan, blinks, 0, rejected)
+        k = 0
+        while count is None or k < count:
+            nxt = start + self.table.nslots * self.slot_time
+            moved, rejected = self.rebalance()
+            new_plan = dict(self.table.slots)
+            # New tags are programmed now, others after their current slot
+            tasks = [asyncio.ensure_future(self.program(self.tags[eui], nxt, slot))
+                     for eui, slot in new_plan.items() if eui not in plan]
+            for slot, eui in sorted([(s, e) for e, s in plan.items()]):
+                await self.sleep_until(start + (slot+1) * self.slot_time)
+                if eui in new_plan:
+                    tasks.append(asyncio.ensure_future(
+                        self.program(self.tags[eui], nxt, new_plan[eui])))
+            await self.sleep_until(nxt)
+            self.history.append(stats)
+            if report:
+                report(stats)
+            blinks = await asyncio.gather(*tasks)
+            k += 1
+            stats = self.superframe_stats(k, nxt, new_plan, blinks, moved, rejected)
+            start, plan = nxt, new_plan
+
+    # Return statistics for a programmed superframe; blinks whose times
+    # could overlap (allowing for clock errors) are counted as collisions,
+    # and the tags are marked for clock sync
+    def superframe_stats(self, num, start, plan, blinks, moved, rejected=0):
+        stats = SuperframeStats(num, self.table.nslots, len(plan),
+                                self.table.nslots * self.slot_time)
+        stats.moved, stats.rejected = moved, rejected
+        times = sorted([b for b in blinks if b])
+        stats.sent = len(times)
+        stats.late = len(blinks) - len(times)
+        for (t1, err1, eui1), (t2, err2, eui2) in zip(times, times[1:]):
+            if t2 - t1 < self.ftime + err1 + err2:
+                stats.collisions += 1
+                for eui in (eui1, eui2):
+                    if eui in self.tags:
+                        self.tags[eui].synced = None
+        return stats
+
+    # Return aggregate blink rate over all superframes
+    def blink_rate(self):
+        total = sum([s.duration for s in self.history])
+        return sum([s.sent for s in self.history]) / total if total else 0.0
+
+async def main(spifs, count, slot_time, guard):
+    dws = await start_units(spifs)
+    sched = TdmaScheduler(slot_time, guard)
+    for n, dw in enumerate(dws):
+        sched.join(dw, TAG_EUI_BASE + n + 1)
+    print("Slot %1.3f ms (frame %1.3f ms, guard %1.3f ms)" % (sched.slot_time*1e3,
+          sched.ftime*1e3, sched.guard*1e3))
+    try:
+        await sched.run(count, print)
+    finally:
+        print("Total %1.1f blinks/s" % sched.blink_rate())
+
+if __name__ == "__main__":
+    spifs, count, slot_time, guard = [], None, None, SLOT_GUARD
+    args = iter(sys.argv[1:])
+    for arg in args:
+        if arg == "-n":
+            count = int(next(args))
+        elif arg == "-s":
+            slot_time = float(next(args)) / 1000.0
+        elif arg == "-g":
+            guard = float(next(args)) / 1000.0
+        elif arg[0] != '-':
+            spifs.append(parse_spif(arg))
+        else:
+            print("Unrecognised argument '%s'" % arg)
+            spifs = []
+            break
+    if not spifs:
+        print("Usage: dw1000_tdma.py [-n superframes] [-s slot_ms] [-g guard_ms] "
+              "[tcp:|unix:]<IP_ADDR>[:<PORT>] ...")
+        sys.exit(1)
+    try:
+        asyncio.run(main(spifs, count, slot_time, guard))
+    except KeyboardInterrupt:
+        pass
+
+# EOF
@@ -0,0 +1,202 @@
+# Telemetry for DW1000 units: event counters and Rx frame quality
+# Copyright (c) Jeremy P Bentham 2019. See iosoft.blog for details
+#
+# The event counters and quality registers of a unit are read in a single
+# batched transfer, and rates are calculated between snapshots. Values are
+# published as text (in Prometheus format) on a local HTTP port; requests
+# are answered from the last snapshot, so don't generate any SPI traffic.
+
+import sys, time, math, asyncio
+from dw1000_regs import Reg, DW1000, DEF_PULSE_FREQ
+from dw1000_spi import Spi, parse_spif
+
+TELEMETRY_INTERVAL = 1.0    # Default time between snapshots (sec)
+METRICS_PORT= 9140          # Default port for HTTP metrics endpoint
+METRICS_HOST= "127.0.0.1"   # Endpoint is only available locally
+EVC_REGS    = ('EVC_PHE', 'EVC_RSE', 'EVC_FCG', 'EVC_FCE', 'EVC_FFR', 'EVC_OVR',
+               'EVC_STO', 'EVC_PTO', 'EVC_FWTO', 'EVC_TXFS', 'EVC_HPW', 'EVC_TPW')
+QUAL_REGS   = ('RX_FQUAL', 'RX_TIME2', 'RX_FINFO')
+EVC_MOD     = 1 << 12       # Event counters are 12 bits, and wrap round
+POWER_CONST = {16:113.77, 64:121.74}    # Rx power constant 'A' for each PRF
+
+# Telemetry values for one unit
+# Counter totals are kept across wraparound (the counters are cleared by
+# initialisation, so the first values are taken as totals, as are the
+# values after the unit has been reset); rates are per second
+class UnitTelemetry(object):
+    def __init__(self, ident, prf=DEF_PULSE_FREQ):
+        self.ident, self.prf = ident, prf
+        self.counts = {}    # Last raw counter values
+        self.resets = None  # Reset count of unit at last update
+        self.totals = {name: 0 for name in EVC_REGS}
+        self.rates = {name: 0.0 for name in EVC_REGS}
+        self.quality = {}
+        self.time = None
+
+    # Update from register values read at the given time
+    # If the reset count of the unit has changed, the counters have been
+    # cleared, so their values are the number of events since the reset
+    def update(self, regs, t=None, resets=None):
+        t = time.time() if t is None else t
+        vals = {r.name: r for r in regs}
+        dt = None if self.time is None else t - self.time
+        reset, self.resets = resets != self.resets, resets
+        for name in EVC_REGS:
+            count = vals[name].get(name)
+            if name in self.counts:
+                delta = (count - (0 if reset else self.counts[name])) % EVC_MOD
+                self.totals[name] += delta
+                self.rates[name] = delta / dt if dt else 0.0
+            else:
+                self.totals[name] = count
+            self.counts[name] = count
+        self.quality = frame_quality(vals['RX_FQUAL'], vals['RX_TIME2'],
+                                     vals['RX_FINFO'], self.prf)
+        self.time = t
+
+    # Return list of (name, value) for all metrics
+    def metrics(self):
+        vals = []
+        for name in EVC_REGS:
+            label = name[4:].lower()
+            vals.append(("evc_%s_total" % label, self.totals[name]))
+            vals.append(("evc_%s_rate" % label, self.rates[name]))
+        return vals + sorted(self.quality.items())
+
+# Queue reads of counter & quality registers, return list of registers
+# Values are valid when the SPI batch has been flushed
+def queue_reads(spi):
+    return [Reg(name).read(spi) for name in EVC_REGS + QUAL_REGS]
+
+# Return dictionary of quality values for last received frame, including
+# first-path & total Rx power (dBm). If the difference between the two is
+# large, the first path is probably attenuated (non-line-of-sight)
+def frame_quality(fqual, time2, finfo, prf=DEF_PULSE_FREQ):
+    f1, f2, f3 = time2.reg.FP_AMPL1, fqual.reg.FP_AMPL2, fqual.reg.PP_AMPL3
+    cir, nacc = fqual.reg.CIR_PWR, finfo.reg.RXPACC
+    qual = {"std_noise":fqual.reg.STD_NOISE, "fp_ampl1":f1, "fp_ampl2":f2,
+            "fp_ampl3":f3, "cir_pwr":cir, "rxpacc":nacc}
+    a = POWER_CONST.get(prf, POWER_CONST[64])
+    if nacc and f1+f2+f3 and cir:
+        qual["fp_power"] = 10*math.log10(float(f1*f1 + f2*f2 + f3*f3) / (nacc*nacc)) - a
+        qual["rx_power"] = 10*math.log10(float(cir) * (1 << 17) / (nacc*nacc)) - a
+    return qual
+
+# Read telemetry from a unit (blocking interface), in one transfer
+def read_telemetry(dw, telem):
+    dw.spi.begin()
+    regs = queue_reads(dw.spi)
+    dw.spi.flush()
+    telem.prf = config_prf(dw)
+    telem.update(regs, resets=dw.resets)
+    return telem
+
+# Return the PRF a unit is configured for
+def config_prf(dw):
+    return dw.config.params[2] if dw.config else DEF_PULSE_FREQ
+
+# Telemetry collector for a number of units (asyncio interface)
+# poll() is called by the ranging loop when it is safe to access the units;
+# a snapshot is taken if the interval has elapsed
+class Telemetry(object):
+    def __init__(self, dws, interval=TELEMETRY_INTERVAL):
+        self.dws, self.interval = dws, interval
+        self.units = [UnitTelemetry(dw.spi.ident, config_prf(dw.dw)) for dw in dws]
+        self.loop_vals = {}     # Metrics from the ranging loop
+        self.last = None
+        self.snapshots = 0
+        self.server = None
+
+    # Return True if a snapshot is due
+    def due(self):
+        return self.last is None or time.time() - self.last >= self.interval
+
+    # Take snapshot if due, with optional metrics from the ranging loop
+    async def poll(self, loop_vals=None):
+        if loop_vals is not None:
+            self.loop_vals = loop_vals
+        if self.due():
+            await self.collect()
+
+    # Read all units concurrently, one transfer each
+    async def collect(self):
+        self.last = time.time()
+        regs = [queue_reads(dw.spi) for dw in self.dws]
+        await asyncio.gather(*[dw.spi.aflush() for dw in self.dws])
+        for dw, unit, r in zip(self.dws, self.units, regs):
+            unit.prf = config_prf(dw.dw)
+            unit.update(r, self.last, dw.dw.resets)
+        self.snapshots += 1
+
+    # Return metrics as text, one value per line
+    def text(self):
+        lines = ["dw1000_%s %s" % (name, fmt_val(val))
+                 for name, val in sorted(self.loop_vals.items())]
+        for dw, unit in zip(self.dws, self.units):
+            label = '{unit="%s"}' % unit.ident
+            lines += ["dw1000_%s%s %s" % (name, label, fmt_val(val))
+                      for name, val in unit.metrics()]
+            snap = dw.spi.stats.snapshot()
+            lines += ["dw1000_spi_%s%s %s" % (name, label, fmt_val(snap[name]))
+                      for name in dw.spi.stats.COUNTERS + ('rtt_p50', 'rtt_p99')]
+        lines.append("dw1000_telemetry_snapshots %u" % self.snapshots)
+        lines.append("dw1000_telemetry_time %1.3f" % (self.last or 0))
+        return "\n".join(lines) + "\n"
+
+    # Start HTTP server for metrics, on local interface
+    async def serve(self, port=METRICS_PORT, host=METRICS_HOST):
+        self.server = await asyncio.start_server(self.handle, host, port)
+        return self.server
+
+    # Handle HTTP request: any path returns the metrics text
+    async def handle(self, reader, writer):
+        try:
+            line = await reader.readline()
+            while line not in (b'\r\n', b'\n', b''):
+                line = await reader.readline()
+            body = self.text().encode()
+            writer.write(b"HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                         b"Content-Length: %u\r\n\r\n" % len(body) + body)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    # Stop HTTP server
+    def close(self):
+        if self.server:
+            self.server.close()
+        self.server = None
+
+# Return metric value as a string
+def fmt_val(val):
+    return "%u" % val if isinstance(val, int) else "%1.6g" % val
+
+if __name__ == "__main__":
+    # Print telemetry for one unit at intervals
+    interval, spif = TELEMETRY_INTERVAL, None
+    args = iter(sys.argv[1:])
+    for arg in args:
+        if arg == "-i":
+            interval = float(next(args))
+        elif arg[0] != '-':
+            spif = parse_spif(arg)
+        else:
+            print("Unrecognised argument '%s'" % arg)
+            sys.exit(1)
+    if spif is None:
+        print("Usage: dw1000_telemetry.py [-i secs] [tcp:|unix:]<IP_ADDR>[:<PORT>]")
+        sys.exit(1)
+    dw = DW1000(Spi(spif))
+    telem = UnitTelemetry(dw.spi.ident)
+    try:
+        while True:
+            read_telemetry(dw, telem)
+            print(" ".join(["%s:%s" % (name, fmt_val(val)) for name, val in telem.metrics()
+                            if not name.endswith("_total")]))
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+
+# EOF
@@ -0,0 +1,88 @@
+# Two-way ranging calculations for DW1000 timestamps
+# Copyright (c) Jeremy P Bentham 2019. See iosoft.blog for details
+#
+# Timestamps are 40-bit counters, so wrap round every 17.2 seconds; all
+# time differences are calculated modulo 2^40. Single exchanges use Python
+# integers; batches of exchanges use NumPy arrays if available.
+
+import sys, math
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+LIGHT_SPEED = 299702547.0
+TSTAMP_SEC  = 1.0 / (128 * 499.2e6)
+TSTAMP_DIST = LIGHT_SPEED * TSTAMP_SEC
+TSTAMP_BITS = 40
+TSTAMP_MOD  = 1 << TSTAMP_BITS
+NAN         = float('nan')
+MAX_RANGE   = 300.0     # Maximum plausible range (metres)
+
+# Return timestamp difference a-b, allowing for wraparound
+# Works with integers, or NumPy integer arrays
+def tstamp_diff(a, b):
+    return (a - b) % TSTAMP_MOD
+
+# Return single-sided and double-sided distances from round-trip times
+# (initiator) and reply times (responder)
+def twr_calc(round1, round2, reply1, reply2):
+    t1 = (round1 - reply1) / 2
+    t2 = ((round1 * round2) - (reply1 * reply2)) / (round1 + round2 + reply1 + reply2)
+    return t1*TSTAMP_DIST, t2*TSTAMP_DIST
+
+# Return single-sided and double-sided TWR distances from 3 exchanges
+# An invalid exchange gives NaN, as with arrays
+def twr_dists(tx1, rx1, tx2, rx2, tx3, rx3):
+    round1, round2 = tstamp_diff(rx2, tx1), tstamp_diff(rx3, tx2)
+    reply1, reply2 = tstamp_diff(tx2, rx1), tstamp_diff(tx3, rx2)
+    if round1 + round2 + reply1 + reply2 == 0:
+        return NAN, NAN
+    return twr_calc(round1, round2, reply1, reply2)
+
+# Return True if a distance is valid, i.e. not None or NaN
+def valid_dist(dist):
+    return dist is not None and not math.isnan(dist)
+
+# Return True if a distance is valid and physically possible, i.e. not
+# negative, and not beyond the maximum range (metres)
+def valid_range(dist, max_range=MAX_RANGE):
+    return valid_dist(dist) and 0.0 <= dist <= max_range
+
+# Return arrays of single-sided and double-sided distances from arrays
+# (or sequences) of timestamps; invalid exchanges give NaN
+# Without NumPy, lists are returned
+def twr_arrays(tx1, rx1, tx2, rx2, tx3, rx3):
+    if np is None:
+        dists = [twr_dists(*t) for t in zip(tx1, rx1, tx2, rx2, tx3, rx3)]
+        return [d[0] for d in dists], [d[1] for d in dists]
+    tx1, rx1, tx2, rx2, tx3, rx3 = [np.asarray(t, dtype=np.int64)
+                                    for t in (tx1, rx1, tx2, rx2, tx3, rx3)]
+    times = [tstamp_diff(a, b).astype(np.float64) for a, b in
+             ((rx2, tx1), (rx3, tx2), (tx2, rx1), (tx3, rx2))]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return twr_calc(*times)
+
+# Read timestamps from text file, 6 per line (decimal or 0x hex)
+def read_tstamps(fname):
+    rows = []
+    with open(fname) as f:
+        for line in f:
+            vals = line.split()
+            if len(vals) >= 6 and not line.startswith('#'):
+                rows.append([int(v, 0) for v in vals[:6]])
+    return [list(col) for col in zip(*rows)] if rows else 6*[[]]
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: dw1000_twr.py <timestamp_file>")
+        print("  File has tx1 rx1 tx2 rx2 tx3 rx3 on each line")
+        sys.exit(1)
+    ss, ds = twr_arrays(*read_tstamps(sys.argv[1]))
+    for d1, d2 in zip(ss, ds):
+        print("%7.3f %7.3f" % (d1, d2))
+    if len(ds) and np is not None:
+        print("DS mean %7.3f std %7.3f (%u ranges)" % (np.nanmean(ds), np.nanstd(ds),
+                                                      np.count_nonzero(~np.isnan(ds))))
+
+# EOF
@@ -13,9 +13,13 @@
 # RESET 22 (BCM25)  37 (BCM26)
 # NRST  16 (BCM23)  31 (BCM6)
 
-import sys, socket, time, select, spidev, RPi.GPIO as GPIO
+import sys, os, stat, socket, time, select, threading, struct
+try:
+    import spidev, RPi.GPIO as GPIO
+except ImportError:
+    spidev = GPIO = None
 
-VERSION = "0.13"
+VERSION = "0.19"
 
 SPIF1       = 0,0   # First SPI interface
 RST_PIN1    = 22
@@ -25,35 +29,181 @@ SPIF2       = 1,2   # Second SPI interface
 RST_PIN2    = 37
 NRST_PIN2   = 31
 IRQ_PIN2    = 32
+DEVICES     = ((SPIF1, RST_PIN1, NRST_PIN1, IRQ_PIN1),
+               (SPIF2, RST_PIN2, NRST_PIN2, IRQ_PIN2))
 SPI_SPEED   = 2000000
 
 RESET_VAL   = 0xff  # Values for first network byte
 ANS_VAL     = 0xaa
 IRQ_VAL     = 0xfe
+MACRO_DEF   = 0xfd  # Define stored sequence of SPI blocks
+MACRO_RUN   = 0xfc  # Run stored sequence, with optional parameters
+MACRO_PARAM = 0xfb  # Stored block with data from run parameter
+MACRO_IRQ   = 0xfa  # Set stored sequence to be run on IRQ
+WIDE_BLOCK  = 0xff  # Block length byte, followed by 2-byte length
 
-NET_MODE    = "UDP" # UDP or TCP mode
-PORTNUM     = 1401  # Default port (for first SPI interface)
+NET_MODES   = "UDP", "TCP", "UNIX"  # Network transports that can be served
+DEF_MODES   = "UDP",                # Transports served by default
+PORTNUM     = 1401  # Default port for first SPI interface (+1 for second)
+UNIX_PATH   = "/tmp/spi_server%u.sock"  # Unix socket path for each interface
+UNIX_MODE   = 0o600 # Unix socket permissions: owner only
+FRAME_HDR   = struct.Struct('<H')       # Length prefix for stream transports
 portnum     = PORTNUM
 MAXDATA     = 2048
+REPLY_CACHE = 16    # Number of replies kept for retransmitted requests
 
 SOCK_TIMEOUT= 0.005 # Socket read timeout (sec)
 
+FAKE_DEV_ID = [0x30, 0x01, 0xCA, 0xDE]  # Device ID returned by fake hardware
+FAKE_IRQ_REG= 0x0d  # Fake hardware gives IRQ after write to this register
+
 verbose     = False # Global flags
-interrupt   = False
 connection  = None
+toff        = time.time()
 SEQLEN      = 2
 
+# SPI interface, reset and IRQ pins on RPi
+class PiHardware(object):
+    def __init__(self, spif, rst_pin, nrst_pin, irq_pin):
+        self.spif, self.rst_pin, self.nrst_pin = spif, rst_pin, nrst_pin
+        self.irq_pin = irq_pin
+        self.spi = None
+
+    # Open SPI interface, set up pins, call handler on IRQ rising edge
+    def open(self, irq_handler):
+        self.spi = spidev.SpiDev()
+        self.spi.open(*self.spif)
+        self.spi.max_speed_hz = SPI_SPEED
+        self.spi.mode = 0
+        GPIO.setmode(GPIO.BOARD)
+        GPIO.setwarnings(False)
+        GPIO.setup(self.rst_pin, GPIO.OUT)
+        GPIO.setup(self.nrst_pin, GPIO.IN)
+        GPIO.setup(self.irq_pin, GPIO.IN)
+        GPIO.add_event_detect(self.irq_pin, GPIO.RISING,
+                              callback=lambda chan: irq_handler())
+
+    # Do SPI transfer, return response
+    def xfer(self, data):
+        return self.spi.xfer(list(data))
+
+    # Assert or negate reset
+    def reset(self, on):
+        if on:
+            GPIO.output(self.rst_pin, 1)
+            GPIO.setup(self.nrst_pin, GPIO.OUT)
+            GPIO.output(self.nrst_pin, 0)
+            print("Reset pin %u" % self.rst_pin)
+        else:
+            GPIO.output(self.rst_pin, 0)
+            GPIO.setup(self.nrst_pin, GPIO.IN)
+
+    # Close SPI interface; pins are released by GPIO.cleanup() at shutdown
+    def close(self):
+        if self.spi:
+            self.spi.close()
+        self.spi = None
+
+# Fake hardware for testing without an RPi: stores register values, and
+# gives an IRQ (from another thread, as RPi.GPIO) after a write to FAKE_IRQ_REG
+class FakeHardware(object):
+    def __init__(self, *args):
+        self.irq_pin = 0
+        self.irq_handler = None
+        self.regs = {}
+
+    # Save IRQ handler
+    def open(self, irq_handler):
+        self.irq_handler = irq_handler
+
+    # Do SPI transfer, return response
+    def xfer(self, data):
+        write, id = data[0] & 0x80, data[0] & 0x3f
+        hlen, sub = 1, 0
+        if data[0] & 0x40:
+            hlen, sub = 2, data[1] & 0x7f
+            if data[1] & 0x80:
+                hlen, sub = 3, sub + (data[2] << 7)
+        reg = self.regs.setdefault(id, bytearray(FAKE_DEV_ID) if id==0 else bytearray())
+        n = len(data) - hlen
+        if len(reg) < sub + n:
+            reg.extend(bytearray(sub + n - len(reg)))
+        if write:
+            reg[sub:sub+n] = data[hlen:]
+            if id == FAKE_IRQ_REG and self.irq_handler:
+                threading.Thread(target=self.irq_handler).start()
+            return list(data)
+        return list(data[:hlen]) + list(reg[sub:sub+n])
+
+    # Reset: clear registers
+    def reset(self, on):
+        if on:
+            self.regs = {}
+
+    def close(self):
+        pass
+
+# Wake the main loop from another thread, using an eventfd, or pipe if
+# eventfd isn't available
+class Waker(object):
+    def __init__(self):
+        if hasattr(os, 'eventfd'):
+            self.rfd = self.wfd = os.eventfd(0, os.EFD_NONBLOCK)
+        else:
+            self.rfd, self.wfd = os.pipe()
+            os.set_blocking(self.rfd, False)
+            os.set_blocking(self.wfd, False)
+
+    # Wake the main loop
+    def wake(self):
+        try:
+            os.write(self.wfd, (1).to_bytes(8, sys.byteorder))
+        except BlockingIOError:
+            pass
+
+    # Clear wakeup events
+    def clear(self):
+        try:
+            os.read(self.rfd, 4096)
+        except BlockingIOError:
+            pass
+
+    def fileno(self):
+        return self.rfd
+
+# Wait for input on a number of file descriptors, each with a handler
+class Poller(object):
+    def __init__(self):
+        self.epoll = select.epoll()
+        self.handlers = {}
+
+    # Add file descriptor, with function to call when there is input
+    def add(self, fd, handler):
+        self.handlers[fd] = handler
+        self.epoll.register(fd, select.EPOLLIN)
+
+    # Remove file descriptor (must be done before it is closed)
+    def remove(self, fd):
+        if self.handlers.pop(fd, None):
+            self.epoll.unregister(fd)
+
+    # Wait for input, return list of handlers to be called
+    def poll(self):
+        return [self.handlers[fd] for fd, ev in self.epoll.poll() if fd in self.handlers]
+
 # Simple UDP server
 class Server(object):
     def __init__(self):
         self.rxdata, self.txdata = [], []
-        self.sock = self.addr = None
+        self.sock = self.addr = self.client = None
+        self.replies = {}   # Recent replies, keyed by sequence number
 
-    # Open socket
-    def open(self, portnum):
+    # Open socket, call handler when there is input
+    def open(self, portnum, poller, handler):
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.sock.bind(('', portnum))
+        poller.add(self.sock.fileno(), handler)
         return self.sock
 
     # Receive incoming data with timeout
@@ -66,26 +216,27 @@ class Server(object):
         return rxdata
 
     # Receive incoming request, return iterator for data blocks
-    # If sequence number is unchanged, resend last transmission
-    def receive(self):
-        self.rxdata = bytearray(self.recv(MAXDATA))
+    # If the sequence number is in the reply cache, resend the reply
+    # The cache is cleared if there is a new client address
+    def receive(self, timeout=SOCK_TIMEOUT):
+        self.rxdata = bytearray(self.recv(MAXDATA, timeout))
         if len(self.rxdata) > SEQLEN:
             if verbose:
                 tim = time.time() - toff
                 print("%1.3f Rx: %s" % (tim%10.0, hexvals(self.rxdata)))
-            if len(self.txdata)>SEQLEN and self.rxdata[0]==self.txdata[0]:
-                self.xmit(self.txdata, '*')
+            if self.addr != self.client:
+                self.client = self.addr
+                self.replies.clear()
+            if self.rxdata[0] in self.replies:
+                self.xmit(self.replies[self.rxdata[0]], '*')
             else:
                 self.txdata = [self.rxdata[0]]
-                rxd = self.rxdata[SEQLEN-1:]
-                while len(rxd)>1 and len(rxd)>rxd[0]:
-                    n = rxd[0] + 1
-                    yield(rxd[1:n])
-                    rxd = rxd[n:]
+                for data in blocks(self.rxdata[SEQLEN-1:]):
+                    yield data
 
     # Add response data to list
     def send(self, data):
-        self.txdata += [len(data)] + data
+        self.txdata += block_len(len(data)) + list(data)
 
     # Transmit responses
     def xmit(self, txdata, suffix=''):
@@ -94,11 +245,25 @@ class Server(object):
             if verbose:
                 tim = time.time() - toff
                 print("%1.3f Tx: %s %s" % (tim%10.0, hexvals(txd), suffix))
-            self.sock.sendto(txd, self.addr)
+            self.sendto(txd)
 
-    # Transmit an IRQ
-    def xmit_irq(self):
-        self.xmit((0, 1, IRQ_VAL))
+    # Send data to client
+    def sendto(self, txd):
+        self.sock.sendto(txd, self.addr)
+
+    # Transmit responses, and save them in the reply cache
+    def reply(self):
+        self.replies[self.txdata[0]] = self.txdata
+        if len(self.replies) > REPLY_CACHE:
+            del self.replies[next(iter(self.replies))]
+        self.xmit(self.txdata)
+
+    # Transmit an IRQ, with optional readout responses
+    def xmit_irq(self, resps=()):
+        txd = [0, 1, IRQ_VAL]
+        for resp in resps:
+            txd += block_len(len(resp)) + list(resp)
+        self.xmit(txd)
 
     # Close socket
     def close(self):
@@ -106,11 +271,246 @@ class Server(object):
             self.sock.close()
         self.sock = None
 
-# Handle pin-change event: set interrupt flag
-def irq_handler(chan):
-    global interrupt
-    interrupt = True
-    
+# Server for stream (TCP or Unix-domain) connections, one client at a time
+# Each request & response has a 2-byte length prefix, otherwise they are
+# the same as UDP datagrams; there are no retransmissions
+class StreamServer(Server):
+    def __init__(self, family):
+        Server.__init__(self)
+        self.family = family
+        self.lsock = self.poller = self.handler = self.path = None
+        self.buff = bytearray()
+        self.nconns = 0
+
+    # Open listening socket, call handler when there is input
+    # A Unix socket is only accessible by the owner; an old socket is
+    # replaced, but any other file at the path is an error
+    def open(self, addr, poller, handler):
+        self.poller, self.handler = poller, handler
+        self.lsock = socket.socket(self.family, socket.SOCK_STREAM)
+        if self.family == socket.AF_INET:
+            self.lsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.lsock.bind(addr)
+        else:
+            if os.path.lexists(addr) and stat.S_ISSOCK(os.lstat(addr).st_mode):
+                os.unlink(addr)
+            mask = os.umask(0o777 & ~UNIX_MODE)
+            try:
+                self.lsock.bind(addr)
+            finally:
+                os.umask(mask)
+            self.path = addr
+        self.lsock.listen(1)
+        poller.add(self.lsock.fileno(), self.accept)
+        return self.lsock
+
+    # Accept new connection, replacing any existing one
+    def accept(self):
+        conn, addr = self.lsock.accept()
+        self.close_conn()
+        if self.family == socket.AF_INET:
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.nconns += 1
+        self.sock, self.addr = conn, (self.family, self.nconns)
+        self.buff = bytearray()
+        self.poller.add(conn.fileno(), self.handler)
+        if verbose:
+            print("Connection %u %s" % (self.nconns, addr))
+
+    # Receive next request, with timeout if none is buffered
+    def recv(self, maxlen=MAXDATA, timeout=SOCK_TIMEOUT):
+        frame = self.next_frame()
+        if not frame and self.sock:
+            rd, wr, ex = select.select([self.sock], [], [], timeout)
+            if rd:
+                try:
+                    data = self.sock.recv(maxlen + FRAME_HDR.size)
+                except OSError:
+                    data = b''
+                if data:
+                    self.buff += data
+                else:
+                    self.close_conn()
+                frame = self.next_frame()
+        return frame
+
+    # Return next complete request from buffer, or empty list
+    def next_frame(self):
+        if len(self.buff) >= FRAME_HDR.size:
+            n = FRAME_HDR.unpack_from(self.buff)[0] + FRAME_HDR.size
+            if len(self.buff) >= n:
+                frame = self.buff[FRAME_HDR.size:n]
+                del self.buff[:n]
+                return frame
+        return []
+
+    # Send data to client, with length prefix
+    def sendto(self, txd):
+        try:
+            self.sock.sendall(FRAME_HDR.pack(len(txd)) + txd)
+        except OSError:
+            self.close_conn()
+
+    # Close client connection
+    def close_conn(self):
+        if self.sock:
+            self.poller.remove(self.sock.fileno())
+            self.sock.close()
+        self.sock = self.addr = None
+
+    # Close connection & listening socket
+    def close(self):
+        self.close_conn()
+        if self.lsock:
+            self.poller.remove(self.lsock.fileno())
+            self.lsock.close()
+        self.lsock = None
+        if self.path and os.path.exists(self.path):
+            os.unlink(self.path)
+
+# Return iterator for length-prefixed data blocks
+# A length byte of WIDE_BLOCK is followed by a 2-byte length
+def blocks(rxd):
+    n = 0
+    while n < len(rxd):
+        size, n = rxd[n], n+1
+        if size == WIDE_BLOCK:
+            if n+2 > len(rxd):
+                break
+            size, n = rxd[n] | (rxd[n+1] << 8), n+2
+        if n+size > len(rxd):
+            break
+        yield rxd[n:n+size]
+        n += size
+
+# Return length prefix for a block, with 2-byte length if required
+def block_len(n):
+    return [n] if n < WIDE_BLOCK else [WIDE_BLOCK, n & 0xff, n >> 8]
+
+# A DW1000 device, with its hardware interface, servers, and stored sequences
+class Device(object):
+    def __init__(self, num, hw, waker):
+        self.num, self.hw, self.waker = num, hw, waker
+        self.servers = []
+        self.client = None  # Server that received the last request
+        self.interrupt = False
+        self.macros = {}    # Stored sequences of SPI blocks
+        self.irq_macro = 0  # Sequence to run on IRQ (0 if none)
+
+    # Open hardware interface, and a server for each network transport
+    def open(self, portnum, modes, poller):
+        self.hw.open(self.irq_handler)
+        for mode in modes:
+            if mode == "UDP":
+                srv, addr = Server(), portnum
+            elif mode == "TCP":
+                srv, addr = StreamServer(socket.AF_INET), ('', portnum)
+            else:
+                srv, addr = StreamServer(socket.AF_UNIX), UNIX_PATH % self.num
+            srv.open(addr, poller, lambda srv=srv: self.do_requests(srv))
+            self.servers.append(srv)
+        self.client = self.servers[0]
+
+    # Handle a single command block, return response
+    def do_block(self, data):
+        global toff
+        resp = []
+        # Single-byte command is a reset
+        if len(data) == 1:
+            if data[0] == RESET_VAL:
+                self.hw.reset(True)
+                toff = time.time()
+                self.interrupt = False
+            else:
+                self.hw.reset(False)
+            resp = [data[0]]
+        # Store a sequence of SPI blocks
+        elif len(data) > 1 and data[0] == MACRO_DEF:
+            self.macros[data[1]] = [bytearray(d) for d in blocks(data[2:])]
+            if verbose:
+                print("Macro %u: %u blocks" % (data[1], len(self.macros[data[1]])))
+            resp = [MACRO_DEF, data[1]]
+        # Set sequence to be run on IRQ
+        elif len(data) > 1 and data[0] == MACRO_IRQ:
+            self.irq_macro = data[1]
+            resp = [MACRO_IRQ, data[1]]
+        # Multi-byte command: send to SPI
+        elif len(data) > 1:
+            resp = self.hw.xfer(data)
+            # Change 1st byte of read response to be 'AA'
+            if data[0] & 0x80 == 0:
+                resp[0] = ANS_VAL
+        return resp
+
+    # Run a stored sequence, substituting parameters, return list of responses
+    # First response is the number of blocks run (0 if sequence not defined)
+    def run_macro(self, data):
+        seq = self.macros.get(data[1], [])
+        params = list(blocks(data[2:]))
+        resps = [[MACRO_RUN, len(seq)]]
+        for block in seq:
+            if block[0] == MACRO_PARAM:
+                param = params[block[1]] if block[1] < len(params) else bytearray()
+                block = block[2:] + param
+            resps.append(self.do_block(block))
+        return resps
+
+    # Handle IRQ (called from GPIO thread): set interrupt flag, wake main loop
+    def irq_handler(self):
+        self.interrupt = True
+        self.waker.wake()
+
+    # If interrupt has been received, send IRQ message and readout data
+    def check_irq(self):
+        if self.interrupt:
+            if verbose:
+                tim = time.time() - toff
+                print("%1.3f IRQ pin %u" % ((tim % 10.0), self.hw.irq_pin))
+            self.interrupt = False
+            resps = self.run_macro([MACRO_RUN, self.irq_macro])[1:] if self.irq_macro else []
+            self.client.xmit_irq(resps)
+
+    # Handle incoming requests on a server until none are waiting
+    # IRQs are forwarded (to the last client) between requests
+    def do_requests(self, sock):
+        while True:
+            sent = False
+            for data in sock.receive(0):
+                if len(data) > 1 and data[0] == MACRO_RUN:
+                    resps = self.run_macro(data)
+                else:
+                    resps = [self.do_block(data)]
+                for resp in resps:
+                    if resp:
+                        sock.send(resp)
+                        sent = True
+            if sent:
+                sock.reply()
+            if not sock.rxdata:
+                break
+            self.client = sock
+            self.check_irq()
+
+    # Close hardware interface and servers
+    def close(self):
+        self.hw.close()
+        for srv in self.servers:
+            srv.close()
+
+# Main loop for all devices: wait for network requests or IRQ
+# The wakeup handler is called first, so no IRQ is missed
+def serve(devs, poller, waker):
+    poller.add(waker.fileno(), waker.clear)
+    while True:
+        handlers = poller.poll()
+        if waker.clear in handlers:
+            waker.clear()
+        for dev in devs:
+            dev.check_irq()
+        for handler in handlers:
+            if handler != waker.clear:
+                handler()
+
 # Return string with hex values of bytes    
 def hexvals(data):
     return " ".join(["%02X" % b for b in bytearray(data)])
@@ -118,77 +518,64 @@ def hexvals(data):
 if __name__ == "__main__":
     # Handle command-line args
     print("SPI_SERVER v" + VERSION)
-    for arg in sys.argv[1:]:
+    fake = False
+    modes = DEF_MODES
+    devnums = None
+    args = iter(sys.argv[1:])
+    for arg in args:
         if arg.lower() == "-v":
             verbose = True
+        elif arg.lower() == "-f":
+            fake = True
+        elif arg.lower() == "-d":
+            devnums = [int(n) for n in next(args).split(',')]
+        elif arg.lower() == "-t":
+            modes = next(args).upper().split(',')
+            if not set(modes) <= set(NET_MODES):
+                print("Unknown transport in '%s'" % ",".join(modes))
+                sys.exit(1)
         elif arg[0].isdigit():
             portnum = int(arg)
         else:
             print("Unrecognised argument '%s'" % arg)
+            print("Usage: spi_server.py [-v] [-f] [-d 1,2] [-t udp,tcp,unix] [port]")
+            print("  -f: fake hardware, -d: devices to serve, -t: transports (default udp)")
+            print("  Without -d, serves device 1 on port %u, or device 2 on another port" % PORTNUM)
+            sys.exit(1)
+    if not fake and spidev is None:
+        print("Can't import spidev & RPi.GPIO; use -f for fake hardware")
+        sys.exit(1)
 
-    # Set up SPI interface; use 2nd if 2nd port number
-    spif = SPIF1 if portnum==PORTNUM else SPIF2
-    rst_pin = RST_PIN1 if portnum==PORTNUM else RST_PIN2
-    nrst_pin = NRST_PIN1 if portnum==PORTNUM else NRST_PIN2
-    irq_pin = IRQ_PIN1 if portnum==PORTNUM else IRQ_PIN2
-    spi = spidev.SpiDev()
-    spi.open(*spif)
-    spi.max_speed_hz = SPI_SPEED
-    spi.mode = 0
-
-    # Set up board I/O
-    GPIO.setmode(GPIO.BOARD)
-    GPIO.setwarnings(False)
-    GPIO.setup(rst_pin, GPIO.OUT)
-    GPIO.setup(nrst_pin, GPIO.IN)
-    GPIO.setup(irq_pin, GPIO.IN)
-    GPIO.add_event_detect(irq_pin, GPIO.RISING, callback=irq_handler)
-
-    # Set up server
-    sock = Server()
-    sock.open(portnum)
-    print("Listening on UDP port %u" % portnum)
-
-    resp = bytearray(spi.xfer(5*[0]))
-    print("Device ID: %s" % hexvals(resp))
+    # Set up SPI interfaces, board I/O and servers
+    # By default, serve one device: the first if the default port number,
+    # otherwise the second. If devices are specified, each has its own
+    # port: base port number + device number - 1
+    if devnums is None:
+        ports = {1 if portnum==PORTNUM else 2: portnum}
+    else:
+        ports = {num: portnum + num - 1 for num in devnums}
+    hwclass = FakeHardware if fake else PiHardware
+    poller, waker = Poller(), Waker()
+    devs = []
+    for num, port in ports.items():
+        dev = Device(num, hwclass(*DEVICES[num-1]), waker)
+        dev.open(port, modes, poller)
+        resp = bytearray(dev.hw.xfer(5*[0]))
+        print("Device %u on port %u (%s), ID: %s" % (num, port,
+              ",".join(modes), hexvals(resp)))
+        if "UNIX" in modes:
+            print("  Unix socket %s" % (UNIX_PATH % num))
+        devs.append(dev)
 
     # Main loop
     toff = time.time()
-    while True:
-        resp = []
-        # If interrupt has been received, send single-byte message
-        if interrupt:
-            if verbose:
-                tim = time.time() - toff
-                print("%1.3f IRQ pin %u" % ((tim % 10.0), irq_pin))
-            sock.xmit_irq()
-            interrupt = False
-        # Check for incoming commands
-        for data in sock.receive():
-            # Single-byte command is a reset
-            if len(data) == 1:
-                if data[0] == RESET_VAL:
-                    GPIO.output(rst_pin, 1)
-                    GPIO.setup(nrst_pin, GPIO.OUT)
-                    GPIO.output(nrst_pin, 0)
-                    print("Reset pin %u" % rst_pin)
-                    toff = time.time()
-                    interrupt = False
-                else:
-                    GPIO.output(rst_pin, 0)
-                    GPIO.setup(nrst_pin, GPIO.IN)
-                resp = [data[0]]
-            # Multi-byte command: send to SPI
-            elif len(data) > 1:
-                resp = spi.xfer(data)
-                # Change 1st byte of read response to be 'AA'
-                if data[0] & 0x80 == 0:
-                    resp[0] = ANS_VAL
-            if resp:
-                sock.send(resp)
-        if len(resp):
-            sock.xmit(sock.txdata)
-    GPIO.cleanup()
-    sock.close()
+    try:
+        serve(devs, poller, waker)
+    except KeyboardInterrupt:
+        pass
+    for dev in devs:
+        dev.close()
+    if not fake:
+        GPIO.cleanup()
 
 # EOF
@@ -0,0 +1,105 @@
+# Tests of DW1000 ranging against the simulator, and the SPI server with fake hardware
+# Copyright (c) Jeremy P Bentham 2019. See iosoft.blog for details
+#
+# Run with: python -m pytest test_dw1000.py
+
+import sys, os, asyncio, subprocess, pytest
+from dw1000_sim import Simulator
+from dw1000_spi import Spi
+from dw1000_regs import DW1000, Reg, REGDEFS
+from dw1000_async import start_units
+from dw1000_range import exchange, delayed_exchange, range_frame
+from dw1000_multi import Ranger
+from dw1000_twr import twr_dists
+
+SIM_PORT    = 17401     # First port number for simulated units
+SERVER_PORT = 17501     # Port number for SPI server with fake hardware
+DISTANCE    = 3.0       # Distance between simulated units (metres)
+TOLERANCE   = 0.05      # Max range error (metres)
+EXCHANGES   = 10        # Number of exchanges in each test
+
+# Two simulated units, initialised
+@pytest.fixture(scope="module")
+def dws():
+    sim = Simulator(2, SIM_PORT, distance=DISTANCE).start()
+    dws = [DW1000(Spi(spif, str(n+1))) for n, spif in enumerate(sim.spifs())]
+    for dw in dws:
+        dw.reset()
+        dw.initialise()
+    yield dws
+    for dw in dws:
+        dw.spi.close()
+    sim.stop()
+
+# Return list of DS-TWR ranges from a number of exchanges
+def ranges(func, dws):
+    frame1, frame2 = range_frame(1), range_frame(2)
+    dists = []
+    for n in range(EXCHANGES):
+        tstamps = func(dws[0], dws[1], frame1, frame2)
+        assert tstamps is not None
+        dists.append(twr_dists(*tstamps)[1])
+    return dists
+
+def test_exchange(dws):
+    for dist in ranges(exchange, dws):
+        assert dist == pytest.approx(DISTANCE, abs=TOLERANCE)
+
+def test_delayed_exchange(dws):
+    for dist in ranges(delayed_exchange, dws):
+        assert dist == pytest.approx(DISTANCE, abs=TOLERANCE)
+
+# Once the Tx macro is defined, and TX_FCTRL is in the shadow cache, a
+# transmission is a single transfer
+def test_macro_transmit(dws):
+    dw, key = dws[0], REGDEFS['TX_FCTRL'].key
+    dw.transmit(bytes(10))
+    for n in range(EXCHANGES):
+        xfers = dw.spi.stats.xfers
+        dw.transmit(bytes(10))
+        assert dw.spi.stats.xfers - xfers == 1
+        assert key in dw.spi.shadow
+
+# Disjoint pairs of units on the same air are time-slotted by default;
+# if the zones are wrong, frames from the other pair are rejected, rather
+# than giving bad ranges
+@pytest.mark.parametrize("zones, nslots", [(None, 2), ([0, 0, 1, 1], 1)])
+def test_ranger_shared_air(zones, nslots):
+    sim = Simulator(4, SIM_PORT+10, distance=DISTANCE).start()
+    async def run():
+        units = await start_units(sim.spifs())
+        ranger = Ranger(units, [(0, 1), (2, 3)], zones)
+        await ranger.run(EXCHANGES)
+        for dw in units:
+            dw.spi.close()
+        return ranger
+    try:
+        ranger = asyncio.run(run())
+    finally:
+        sim.stop()
+    assert len(ranger.slots) == nslots
+    for stats in ranger.stats.values():
+        if stats.count:
+            assert stats.total / stats.count == pytest.approx(DISTANCE, abs=TOLERANCE)
+        if zones is None:
+            assert stats.count == EXCHANGES and stats.errors == 0
+
+# SPI server with fake hardware: device ID, and IRQ forwarding; the fake
+# hardware gives an IRQ after a write to SYS_CTRL
+def test_fake_server():
+    server = subprocess.Popen([sys.executable, "spi_server.py", "-f", str(SERVER_PORT)],
+                              cwd=os.path.dirname(os.path.abspath(__file__)),
+                              stdout=subprocess.PIPE, universal_newlines=True)
+    try:
+        while "Device" not in server.stdout.readline():
+            assert server.poll() is None
+        dw = DW1000(Spi(("UDP", "127.0.0.1", SERVER_PORT)))
+        assert Reg('DEV_ID').read(dw.spi).value == 0xDECA0130
+        Reg('SYS_CTRL').set('TXSTRT', 1).write(dw.spi)
+        assert dw.check_irq()
+        dw.spi.close()
+    finally:
+        server.terminate()
+        server.wait()
+
+# EOF